@@ -2,13 +2,17 @@
 # AES 256 encryption/decryption using pycrypto library
  
 import base64
+import binascii
 import hashlib
+import re
 from Crypto.Cipher import AES
 from Crypto import Random
  
 BLOCK_SIZE = 16
 pad = lambda s: s + (BLOCK_SIZE - len(s)%BLOCK_SIZE)*chr(BLOCK_SIZE - len(s) % BLOCK_SIZE)
 unpad = lambda s: s[:-ord(s[len(s) - 1:])]
+BASE64_REGEX = re.compile (r"^[A-Za-z0-9+/]+={0,2}$")
+MIN_ENCODED_LENGTH = 44 # base64 length of the IV + one block, the shortest valid ciphertext
 
 def encrypt(raw: str, password: str):
     private_key = hashlib.sha256(password.encode("utf-8")).digest()
@@ -25,6 +29,50 @@ def decrypt(enc, password):
     cipher = AES.new(private_key, AES.MODE_CBC, iv)
     return unpad(cipher.decrypt(enc[16:])).decode ("utf-8")
 
+class Codec:
+    """ 
+        Same scheme as encrypt & decrypt, but the key is derived once for the password instead of on every call.
+        decrypt rejects malformed input before doing any decryption
+    """
+    def __init__ (self, password: str):
+        self.key = hashlib.sha256(password.encode("utf-8")).digest()
+        self.random = Random.new()
+
+    def encrypt (self, raw: str):
+        raw = raw.encode("utf-8")
+        padding = BLOCK_SIZE - len(raw) % BLOCK_SIZE
+        iv = self.random.read(AES.block_size)
+        cipher = AES.new(self.key, AES.MODE_CBC, iv)
+        return base64.b64encode(iv + cipher.encrypt(raw + bytes([padding])*padding)).decode("utf-8")
+    def decrypt (self, enc: str):
+        """ Raises ValueError if the input is not something encrypt could have produced """
+        if len(enc) < MIN_ENCODED_LENGTH or len(enc) % 4 != 0 or not BASE64_REGEX.match(enc):
+            raise ValueError("not a valid code")
+        try:
+            enc = base64.b64decode(enc, validate=True)
+        except binascii.Error as err:
+            raise ValueError(f"not valid base64: {err}")
+        if len(enc) % BLOCK_SIZE != 0:
+            raise ValueError("length is not a multiple of the block size")
+        cipher = AES.new(self.key, AES.MODE_CBC, enc[:BLOCK_SIZE])
+        dec = cipher.decrypt(enc[BLOCK_SIZE:])
+        padding = dec[-1]
+        if not 0 < padding <= BLOCK_SIZE or dec[-padding:] != bytes([padding])*padding: # a wrong key or tampered code won't have valid padding
+            raise ValueError("invalid padding")
+        return dec[:-padding].decode("utf-8")
+
+    def encrypt_many (self, raws: list):
+        return [ self.encrypt(raw) for raw in raws ]
+    def decrypt_many (self, encs: list):
+        """ Decrypt a batch of codes; malformed codes decrypt to None """
+        decs = []
+        for enc in encs:
+            try:
+                decs.append (self.decrypt(enc))
+            except (ValueError, UnicodeDecodeError):
+                decs.append (None)
+        return decs
+
 def test_aes ():
     password = base64.b64encode(Random.new().read(32)).decode ("utf-8")
     message = base64.b64encode(Random.new().read(128)).decode ("utf-8")
@@ -33,5 +81,17 @@ def test_aes ():
     dec = decrypt (enc, password)
     assert message == dec
 
+def test_codec ():
+    password = base64.b64encode(Random.new().read(32)).decode ("utf-8")
+    codec = Codec (password)
+    messages = [ "adhiraj.singh_ug21@ashoka.edu.in", "", "a"*16 ]
+
+    encs = codec.encrypt_many (messages)
+    assert codec.decrypt_many (encs) == messages
+    assert [ decrypt (enc, password) for enc in encs ] == messages # compatible with the plain functions
+    assert codec.decrypt (encrypt (messages[0], password)) == messages[0]
+    assert codec.decrypt_many (["", "not base64!", "abcd", encs[0][:-4], encs[0][:-1] + "!"]) == [None]*5
+
 if __name__ == "__main__":
-    test_aes ()
\ No newline at end of file
+    test_aes ()
+    test_codec ()
\ No newline at end of file
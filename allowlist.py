@@ -0,0 +1,97 @@
+"""
+List of email addresses allowed to join in addition to the ones matching the regex (eg. alumni), read from CSV files
+
+"""
+import csv
+import os
+import threading
+import time
+
+def read_column_of_csv (file, column):
+    with open (file) as csv_file:
+        reader = csv.DictReader (csv_file)
+        rows = [ row[column] for row in reader ]
+        return rows
+    return []
+
+class EmailAllowlist:
+    """
+        Emails read from a column of one or more CSV files, indexed by domain.
+        The files are checked for changes at most every 'check_interval' seconds & changed files are reloaded on a background thread,
+        so lookups never wait on a reload. 'version' increases every time the contents change
+    """
+    def __init__ (self, sources: list, check_interval: float=30):
+        self.sources = sources # list of { "file": ..., "column": ... }
+        self.check_interval = check_interval
+        self.emails = dict () # file -> set of normalized emails in it
+        self.mtimes = dict () # file -> modified time when it was last read
+        self.by_domain = dict () # domain -> frozenset of the local parts allowed in it
+        self.version = 0
+        self.last_check = time.monotonic ()
+        self.reloading = threading.Lock ()
+        self.reload () # the first load is done synchronously
+
+    def __contains__ (self, email: str):
+        """ email must be lowercase """
+        local, _, domain = email.rpartition ("@")
+        return local in self.by_domain.get (domain, ())
+    def __len__ (self):
+        return sum (len (locals_) for locals_ in self.by_domain.values ())
+
+    def maybe_reload (self):
+        """ Start a reload in the background if it's time to check the files again; returns immediately """
+        if time.monotonic () - self.last_check < self.check_interval or self.reloading.locked ():
+            return
+        self.last_check = time.monotonic ()
+        threading.Thread (target=self.reload, name="allowlist", daemon=True).start ()
+    def reload (self):
+        """ Re-read the files that changed since they were last read & rebuild the index if any did """
+        if not self.reloading.acquire (blocking=False):
+            return
+        try:
+            changed = False
+            for source in self.sources:
+                file = source["file"]
+                mtime = os.path.getmtime (file)
+                if self.mtimes.get (file) == mtime:
+                    continue
+                emails = ( email.strip ().lower () for email in read_column_of_csv (file, source["column"]) )
+                self.emails[file] = set ( filter (lambda x: len(x) > 0, emails) )
+                self.mtimes[file] = mtime
+                changed = True
+                print (f"read {len(self.emails[file])} valid emails from {file}")
+            if changed:
+                by_domain = dict ()
+                for emails in self.emails.values ():
+                    for email in emails:
+                        local, _, domain = email.rpartition ("@")
+                        by_domain.setdefault (domain, set ()).add (local)
+                self.by_domain = { domain: frozenset (locals_) for domain, locals_ in by_domain.items () } # swapped in one go, lookups see either the old or the new index
+                self.version += 1
+        except Exception as err: # keep using the old list
+            print (f"failed to reload valid email list: {err}")
+        finally:
+            self.reloading.release ()
+
+def test_allowlist ():
+    import tempfile
+    with tempfile.TemporaryDirectory () as directory:
+        file = os.path.join (directory, "emails.csv")
+        with open (file, "w") as f:
+            f.write ("Name,Email\nA,Some.One@alumni.ashoka.edu.in\nB,\n")
+        allowlist = EmailAllowlist ([{"file": file, "column": "Email"}], check_interval=0)
+        assert "some.one@alumni.ashoka.edu.in" in allowlist
+        assert "other.one@alumni.ashoka.edu.in" not in allowlist and "some.one@ashoka.edu.in" not in allowlist
+        assert len (allowlist) == 1
+
+        with open (file, "a") as f:
+            f.write ("C,other.one@alumni.ashoka.edu.in\n")
+        os.utime (file, (time.time () + 5, time.time () + 5)) # make sure the modified time changes
+        version = allowlist.version
+        allowlist.reload ()
+        assert "other.one@alumni.ashoka.edu.in" in allowlist and allowlist.version == version + 1
+        allowlist.reload () # nothing changed
+        assert allowlist.version == version + 1
+
+if __name__ == "__main__":
+    test_allowlist ()
@@ -0,0 +1,187 @@
+"""
+Offline benchmarks, run as: python3 benchmark.py <name> [args]
+
+"""
+import os
+import tempfile
+import time
+from contextlib import redirect_stdout
+from sys import argv
+
+def bench_waits (total: int=300, gui: bool=False):
+    """ Scroll through & handle a local page mimicking 'total' FB requests; compares with the fixed sleeps used before """
+    from fakes import render_requests_page, serve_page
+    from fb_automation import create_browser, scroll_to_bottom, handle_requests, DEFAULT_WAITS
+
+    page_size = 25
+    server, url = serve_page (render_requests_page (total, page_size=page_size))
+    config = {"group_url": url}
+    browser = create_browser (gui)
+    try:
+        browser.get (config["group_url"])
+        start = time.time ()
+        scroll_to_bottom (browser, DEFAULT_WAITS["scroll"])
+        scroll_time = time.time () - start
+
+        start = time.time ()
+        handled = handle_requests (browser, config, lambda requester, name, answer: int (name.split (" ")[-1]) % 2 == 0)
+        handle_time = time.time () - start
+    finally:
+        browser.quit ()
+        server.shutdown ()
+
+    scroll_steps = (total + page_size - 1)//page_size # scrolls needed to load every page, each used to sleep 4s
+    print (f"scroll_to_bottom: {scroll_time:.1f}s for {total} requests (fixed sleeps: >= {scroll_steps*4}s)")
+    print (f"handle_requests: {handle_time:.1f}s for {handled} requests, includes loading & scrolling the page (fixed sleeps: >= {scroll_steps*4 + 5 + total}s)")
+
+def bench_aes (total: int=10000):
+    """ Encrypt & decrypt 'total' codes, & reject 'total' malformed ones, with the plain functions & with a Codec """
+    from aes import encrypt, decrypt, Codec
+
+    password = "superSecureEncryptionKey"
+    emails = [ f"some.one{i}_ug21@ashoka.edu.in" for i in range (total) ]
+    malformed = [ f"not a code {i}" for i in range (total) ]
+    def decrypt_or_none (code):
+        try:
+            return decrypt (code, password)
+        except Exception:
+            return None
+
+    timings = dict ()
+    start = time.time ()
+    codes = [ encrypt (email, password) for email in emails ]
+    timings["functions", "encrypt"] = time.time () - start
+    start = time.time ()
+    [ decrypt_or_none (code) for code in codes ]
+    timings["functions", "decrypt"] = time.time () - start
+    start = time.time ()
+    [ decrypt_or_none (code) for code in malformed ]
+    timings["functions", "reject"] = time.time () - start
+
+    codec = Codec (password)
+    start = time.time ()
+    codes = codec.encrypt_many (emails)
+    timings["codec", "encrypt"] = time.time () - start
+    start = time.time ()
+    codec.decrypt_many (codes)
+    timings["codec", "decrypt"] = time.time () - start
+    start = time.time ()
+    codec.decrypt_many (malformed)
+    timings["codec", "reject"] = time.time () - start
+
+    for op in ["encrypt", "decrypt", "reject"]:
+        before, after = timings["functions", op], timings["codec", op]
+        print (f"{op} x{total}: functions {before*1000:.0f}ms, codec {after*1000:.0f}ms ({before/after:.1f}x)")
+
+BENCH_CONFIG = {
+    "fb": { "group_url": "https://www.facebook.com/groups/bench/requests/", "scrape_with_script": True },
+    "valid_email_regex": "^[a-z0-9]{1,20}\\.[a-z0-9]{1,20}_(ug|asp)[0-9]{2}@ashoka.edu.in$",
+    "responses": {
+        "wrapper": "Hello [name],\n\n[content]",
+        "invalid_email": "invalid",
+        "duplicate_email": "duplicate",
+        "valid_email": "Here is your code:\n\n[code]",
+        "accept_email": "accepted"
+    },
+    "email_subject": "Join FB Group",
+    "accepted_email_subject": "Accepted to FB group",
+    "encryption_key": "benchmarkEncryptionKey"
+}
+
+def measure (stage: str, fn):
+    """ Run fn, returns its wall time, GMail API calls made, peak memory traced (in bytes) & result """
+    import tracemalloc
+    import metrics
+    tracemalloc.start ()
+    metrics.registry.set_stage (stage)
+    start = time.time ()
+    try:
+        with open (os.devnull, "w") as devnull, redirect_stdout (devnull): # the app prints a line per email & request
+            result = fn ()
+    finally:
+        seconds = time.time () - start
+        _, peak = tracemalloc.get_traced_memory ()
+        tracemalloc.stop ()
+    counts = metrics.registry.cycle_counts.pop (stage, dict ())
+    api_calls = sum (value for name, value in counts.items () if name.startswith ("gmail_api_calls_total"))
+    return seconds, api_calls, peak, result
+
+def run_cycle (total: int, gmail_latency: float, error_rate: float, browser_latency: float):
+    """ 
+        A full cycle with a backlog of 'total' emails & 'total' FB requests; returns a row per stage,
+        with the number of items the stage handled & the number it left behind (emails still unread, requests still pending)
+    """
+    import gmail_utils
+    from fakes import FakeGmailService, FakeBrowser
+    from fb_automation import handle_requests
+    from rate_limit import QuotaLimiter
+    from verification import Verifier
+
+    gmail_utils.limiter = QuotaLimiter (1e9, base_delay=0.01) # measure the app, not the quota; throttled requests are still retried
+    service = FakeGmailService (latency=gmail_latency, error_rate=error_rate)
+    for i in range (total): # every tenth email is from someone who isn't allowed to join
+        sender = f"Someone <x{i}@gmail.com>" if i % 10 == 0 else f"Some One <some.one{i}_ug21@ashoka.edu.in>"
+        service.add_message (sender, BENCH_CONFIG["email_subject"])
+
+    rows = []
+    with tempfile.TemporaryDirectory () as directory:
+        config = { **BENCH_CONFIG, "datafile": os.path.join (directory, "ledger.csv"), "sync_state": os.path.join (directory, "sync.json"), "journal": os.path.join (directory, "journal.csv") }
+        with open (os.devnull, "w") as devnull, redirect_stdout (devnull):
+            verifier = Verifier (config, service_factory=lambda: service)
+        try:
+            seconds, calls, peak, items = measure ("fetch", verifier.fetch)
+            unread = sum (1 for m in service.mailbox.values () if "UNREAD" in m["labelIds"] and "SENT" not in m["labelIds"])
+            rows.append (("Verifier.fetch", seconds, calls, service.round_trips, peak, items, unread))
+
+            # codes of people who haven't joined yet, some codes repeated & some junk
+            emails = [ f"new.person{i}_ug21@ashoka.edu.in" for i in range (total) ]
+            codes = verifier.codec.encrypt_many (emails)
+            answers = [ "junk" if i % 10 == 0 else codes[i//2 if i % 10 == 5 else i] for i in range (total) ]
+            round_trips = service.round_trips
+            def validate_all ():
+                verdicts = [ verifier.validate (f"bench#{i}", f"Person {i}", answer) for i, answer in enumerate (answers) ]
+                verifier.outbox.drain ()
+                return sum (1 for verdict in verdicts if verdict is not None)
+            seconds, calls, peak, items = measure ("validate", validate_all)
+            rows.append (("Verifier.validate", seconds, calls, service.round_trips - round_trips, peak, items, total - items))
+
+            for stage, fb_config in [ ("handle_requests", config["fb"]), ("pipelined", { **config["fb"], "pipeline": True }) ]:
+                emails = [ f"fb{len (rows)}.person{i}_ug21@ashoka.edu.in" for i in range (total) ]
+                browser = FakeBrowser (list (zip ([ f"{stage} {i}" for i in range (total) ], verifier.codec.encrypt_many (emails))), latency=browser_latency)
+                def handle ():
+                    handled = handle_requests (browser, fb_config, verifier.validate, verifier.clicked, verifier.scraped)
+                    verifier.outbox.drain ()
+                    return handled
+                seconds, calls, peak, items = measure (stage, handle)
+                pending = sum (1 for r in browser.requests if not r["handled"])
+                rows.append ((stage, seconds, calls, browser.round_trips, peak, items, pending))
+        finally:
+            verifier.close ()
+    return rows
+
+def bench_cycle (*sizes):
+    """ 
+        Drive Verifier.fetch, Verifier.validate & handle_requests end to end against the fake GMail service & fake browser,
+        for each backlog size. Round trips are HTTP requests to GMail (batches count once) or WebDriver calls to the browser.
+        Every stage should handle the entire backlog in one cycle; stages that don't are flagged & the benchmark exits with an error
+    """
+    sizes = sizes or (10, 100, 1000, 10000)
+    print (f"{'backlog':>8} {'stage':<18} {'seconds':>8} {'api calls':>10} {'round trips':>12} {'peak MB':>8} {'items':>7} {'left':>6}")
+    mismatches = 0
+    for total in sizes:
+        for stage, seconds, calls, round_trips, peak, items, left in run_cycle (total, gmail_latency=0.002, error_rate=0.01, browser_latency=0.0005):
+            flag = "" if items == total and left == 0 else "  <- MISMATCH"
+            mismatches += 1 if flag else 0
+            print (f"{total:>8} {stage:<18} {seconds:>8.2f} {calls:>10} {round_trips:>12} {peak/2**20:>8.1f} {items:>7} {left:>6}{flag}")
+    if mismatches:
+        raise SystemExit (f"{mismatches} stages did not handle their entire backlog")
+
+BENCHMARKS = {
+    "waits": bench_waits,
+    "aes": bench_aes,
+    "cycle": bench_cycle
+}
+
+if __name__ == "__main__":
+    name, args = argv[1], [ int (arg) for arg in argv[2:] ]
+    BENCHMARKS[name] (*args)
@@ -0,0 +1,44 @@
+"""
+Small bounded cache used to memoize results across cycles
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """ Mapping that holds at most max_size entries, evicting the least recently used ones & the ones older than ttl seconds """
+    def __init__ (self, max_size: int=10000, ttl: float=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict () # key -> (time stored, value), least recently used first
+        self.lock = threading.Lock ()
+
+    def get (self, key, default=None):
+        with self.lock:
+            entry = self.data.get (key)
+            if entry is None:
+                return default
+            stored, value = entry
+            if self.ttl is not None and time.monotonic () - stored > self.ttl: # expired
+                del self.data[key]
+                return default
+            self.data.move_to_end (key)
+            return value
+    def put (self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic (), value)
+            self.data.move_to_end (key)
+            while len (self.data) > self.max_size:
+                self.data.popitem (last=False)
+    def pop (self, key, default=None):
+        """ Remove the entry, returns its value """
+        with self.lock:
+            entry = self.data.pop (key, None)
+            return default if entry is None else entry[1]
+    def clear (self):
+        with self.lock:
+            self.data.clear ()
+
+    def __len__ (self):
+        return len (self.data)
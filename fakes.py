@@ -0,0 +1,405 @@
+"""
+In-process stand-ins for the external services the app talks to, so the modules can be exercised offline.
+
+"""
+import base64
+import email
+import http.server
+import itertools
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+import httplib2
+from googleapiclient.errors import HttpError
+
+HISTORY_KEYS = {"messageAdded": "messagesAdded", "messageDeleted": "messagesDeleted", "labelAdded": "labelsAdded", "labelRemoved": "labelsRemoved"}
+
+class FakeRequest:
+    """ Mimics googleapiclient's HttpRequest; the work is only done on execute () """
+    def __init__ (self, fn, account=None):
+        self.fn = fn
+        self.account = account
+    def execute (self, **kwargs):
+        if self.account is not None:
+            self.account.round_trip ()
+        return self.run ()
+    def run (self):
+        """ Do the work without the simulated round trip, used by batches """
+        if self.account is not None:
+            self.account.maybe_throttle ()
+        return self.fn ()
+
+class FakeBatch:
+    """ Mimics googleapiclient's BatchHttpRequest; the whole batch is one round trip """
+    def __init__ (self, callback, account=None):
+        self.callback = callback
+        self.account = account
+        self.requests = []
+    def add (self, request, request_id=None):
+        self.requests.append ((request_id or str(len(self.requests)), request))
+    def execute (self, **kwargs):
+        if self.account is not None:
+            self.account.round_trip ()
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.run (), None
+            except HttpError as err:
+                response, exception = None, err
+            self.callback (request_id, response, exception)
+
+def http_error (status: int, reason: str=""):
+    """ An HttpError like the ones the API client raises """
+    resp = httplib2.Response ({"status": status})
+    resp.reason = reason
+    return HttpError (resp, reason.encode("utf-8"))
+
+class FakeGmailService:
+    """
+        A GMail account held in memory, implements the subset of the GMail API used in gmail_utils.
+        Every change to a mailbox adds a history record, like the real API.
+        Every round trip takes 'latency' seconds & each request fails with a 429 with a probability of 'error_rate'
+    """
+    def __init__ (self, page_size: int=100, latency: float=0, error_rate: float=0):
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.round_trips = 0
+        self.mailbox = dict () # message ID -> message
+        self.records = [] # history records, oldest first
+        self.history_id = 1000
+        self.min_history_id = self.history_id # history records older than this have 'expired'
+        self.ids = itertools.count (1)
+        self.lock = threading.Lock ()
+        self.failing_sends = dict () # recipient address -> status that sending to it fails with
+
+    def add_message (self, sender: str, subject: str, to: str="me@example.com", labels: list=None):
+        """ Deliver a message to the mailbox; returns its ID """
+        with self.lock:
+            mID = f"m{next(self.ids)}"
+            self.mailbox[mID] = {
+                "id": mID,
+                "threadId": f"t{mID}",
+                "labelIds": list (labels if labels is not None else ["INBOX", "UNREAD"]),
+                "headers": {"Subject": subject, "From": sender, "To": to, "Message-ID": f"<{mID}@example.com>"}
+            }
+            self._record ("messagesAdded", mID)
+        return mID
+    def round_trip (self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep (self.latency)
+    def maybe_throttle (self):
+        if self.error_rate and random.random () < self.error_rate:
+            raise http_error (429, "rateLimitExceeded")
+
+    def expire_history (self):
+        """ Drop all history records, as GMail does after about a week """
+        with self.lock:
+            self.min_history_id = self.history_id + 1
+            self.records = []
+
+    def _record (self, kind: str, mID: str):
+        self.history_id += 1
+        message = self.mailbox[mID]
+        self.records.append ({
+            "id": str(self.history_id),
+            kind: [ {"message": {"id": mID, "threadId": message["threadId"], "labelIds": list(message["labelIds"])}} ]
+        })
+    def _matches (self, message: dict, q: str):
+        """ Understands the subset of the search syntax the app uses """
+        headers = message["headers"]
+        for term in (q or "").split (" "):
+            if term == "is:unread" and "UNREAD" not in message["labelIds"]:
+                return False
+            if term == "is:sent" and "SENT" not in message["labelIds"]:
+                return False
+            if term.startswith ("subject:") and term[8:].replace ("+", " ").lower () not in headers["Subject"].lower ():
+                return False
+            if term.startswith ("to:") and term[3:].lower () not in headers["To"].lower ():
+                return False
+        return True
+    def _page (self, items: list, pageToken: str, maxResults: int):
+        start = int (pageToken or 0)
+        end = start + (maxResults or self.page_size)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    # API surface
+    def users (self):
+        return self
+    def messages (self):
+        return _FakeMessages (self)
+    def new_batch_http_request (self, callback=None):
+        return FakeBatch (callback, self)
+    def getProfile (self, userId: str):
+        return FakeRequest (lambda: {"emailAddress": "me@example.com", "historyId": str(self.history_id)}, self)
+    def history (self):
+        return _FakeHistory (self)
+
+class _FakeMessages:
+    def __init__ (self, account: FakeGmailService):
+        self.account = account
+    def list (self, userId: str, q: str=None, includeSpamTrash: bool=False, pageToken: str=None, maxResults: int=None):
+        def fn ():
+            with self.account.lock:
+                ids = [ {"id": m["id"], "threadId": m["threadId"]} for m in reversed(list(self.account.mailbox.values())) if self.account._matches (m, q) ]
+            page, token = self.account._page (ids, pageToken, maxResults)
+            result = {"messages": page, "resultSizeEstimate": len(ids)} if page else {"resultSizeEstimate": 0}
+            if token:
+                result["nextPageToken"] = token
+            return result
+        return FakeRequest (fn, self.account)
+    def get (self, userId: str, id: str, format: str="full", metadataHeaders: list=None):
+        def fn ():
+            with self.account.lock:
+                if id not in self.account.mailbox:
+                    raise http_error (404, "Not Found")
+                message = self.account.mailbox[id]
+                headers = [ {"name": name, "value": value} for name, value in message["headers"].items () if not metadataHeaders or name in metadataHeaders ]
+                return {"id": id, "threadId": message["threadId"], "labelIds": list(message["labelIds"]), "payload": {"headers": headers}}
+        return FakeRequest (fn, self.account)
+    def modify (self, userId: str, id: str, body: dict):
+        return self.batchModify (userId, {"ids": [id], **body})
+    def batchModify (self, userId: str, body: dict):
+        def fn ():
+            with self.account.lock:
+                for mID in body["ids"]:
+                    labels = self.account.mailbox[mID]["labelIds"]
+                    for label in body.get ("removeLabelIds", []):
+                        if label in labels:
+                            labels.remove (label)
+                    labels.extend (l for l in body.get ("addLabelIds", []) if l not in labels)
+                    self.account._record ("labelsRemoved", mID)
+        return FakeRequest (fn, self.account)
+    def send (self, userId: str, body: dict):
+        def fn ():
+            message = email.message_from_bytes (base64.urlsafe_b64decode (body["raw"]))
+            for address, status in self.account.failing_sends.items ():
+                if address in message["to"]:
+                    raise http_error (status, "Invalid To header" if status == 400 else "Backend Error")
+            mID = self.account.add_message ("me@example.com", message["subject"], to=message["to"], labels=["SENT"])
+            return {"id": mID, "threadId": self.account.mailbox[mID]["threadId"]}
+        return FakeRequest (fn, self.account)
+
+class _FakeHistory:
+    def __init__ (self, account: FakeGmailService):
+        self.account = account
+    def list (self, userId: str, startHistoryId: str, historyTypes: list=None, pageToken: str=None, maxResults: int=None):
+        def fn ():
+            with self.account.lock:
+                if int (startHistoryId) < self.account.min_history_id:
+                    raise http_error (404, "Requested entity was not found.")
+                records = [ r for r in self.account.records if int(r["id"]) > int(startHistoryId) ]
+                if historyTypes:
+                    keys = [ HISTORY_KEYS[kind] for kind in historyTypes ]
+                    records = [ r for r in records if any(key in r for key in keys) ]
+                history_id = str(self.account.history_id)
+            page, token = self.account._page (records, pageToken, maxResults)
+            result = {"history": page, "historyId": history_id}
+            if token:
+                result["nextPageToken"] = token
+            return result
+        return FakeRequest (fn, self.account)
+
+REQUESTS_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>Requests</title></head>
+<body>
+<div role="main">
+    <div>
+        <div><span>Manage group</span></div>
+        <div><h2>Pending requests</h2></div>
+        <div id="requests"></div>
+    </div>
+</div>
+<script>
+// mimics the FB group requests page: requests load in pages as you scroll & go away a little while after they're handled
+const total = %(total)d, pageSize = %(page_size)d, loadDelay = %(load_delay)d, clickDelay = %(click_delay)d
+const list = document.getElementById("requests")
+document.cookie = "c_user=1" // the session cookie FB sets when logged in
+let loaded = 0, loading = false
+
+const addRequest = i => {
+    const el = document.createElement("div")
+    el.style.height = "120px"
+    el.innerHTML = `
+        <a role="link" href="/user/${i}">avatar</a>
+        <a role="link" href="/user/${i}">Person ${i}</a>
+        <div><span>Send an email from your Ashoka ID & paste the code here</span><div>code-${i}</div></div>
+        <div role="button"><span>Approve</span></div>
+        <div role="button"><span>Decline</span></div>`
+    for (const button of el.querySelectorAll("div[role='button']")) {
+        button.onclick = () => setTimeout(() => el.remove(), clickDelay)
+    }
+    list.appendChild(el)
+}
+const loadPage = () => {
+    const end = Math.min(total, loaded + pageSize)
+    for (; loaded < end; loaded++) {
+        addRequest(loaded)
+    }
+    loading = false
+}
+window.addEventListener("scroll", () => {
+    if (loading || loaded >= total || window.innerHeight + window.scrollY < document.body.scrollHeight - 10) {
+        return
+    }
+    loading = true
+    setTimeout(loadPage, loadDelay)
+})
+loadPage()
+</script>
+</body>
+</html>
+"""
+
+def render_requests_page (total: int, page_size: int=25, load_delay: float=0.3, click_delay: float=0.1):
+    """ HTML of a page that mimics the FB group requests list, with 'total' pending requests """
+    return REQUESTS_PAGE % {"total": total, "page_size": page_size, "load_delay": load_delay*1000, "click_delay": click_delay*1000}
+
+def serve_page (html: str):
+    """ Serve the HTML on localhost (a file:// page can't have cookies); returns the server & the URL of the page """
+    class Handler (http.server.BaseHTTPRequestHandler):
+        def do_GET (self):
+            body = html.encode ("utf-8")
+            self.send_response (200)
+            self.send_header ("Content-Type", "text/html; charset=utf-8")
+            self.send_header ("Content-Length", str(len(body)))
+            self.end_headers ()
+            self.wfile.write (body)
+        def log_message (self, *args):
+            pass
+    server = http.server.ThreadingHTTPServer (("127.0.0.1", 0), Handler)
+    threading.Thread (target=server.serve_forever, daemon=True).start ()
+    return server, f"http://127.0.0.1:{server.server_port}/groups/fixture/requests/"
+
+class FakeElement:
+    """ Part of a request on a FakeBrowser's page; understands the XPaths fb_automation uses """
+    def __init__ (self, browser, request: dict, kind: str, text: str=""):
+        self.browser = browser
+        self.request = request
+        self.kind = kind
+        self.text = text
+        self.id = f"{kind}-{request['id'] if request else 'page'}"
+
+    def _find (self, xpath: str):
+        from fb_automation import APPROVE_XPATH, DECLINE_XPATH, QUESTION_TEXT
+        request = self.request
+        if xpath == APPROVE_XPATH:
+            return FakeElement (self.browser, request, "approve", "Approve")
+        if xpath == DECLINE_XPATH:
+            return FakeElement (self.browser, request, "decline", "Decline")
+        if QUESTION_TEXT in xpath and request["answer"] is not None:
+            return FakeElement (self.browser, request, "question", QUESTION_TEXT)
+        if xpath == "./following-sibling::*" and self.kind == "question":
+            return FakeElement (self.browser, request, "answer", request["answer"])
+        return None
+    def find_elements_by_xpath (self, xpath: str):
+        self.browser.round_trip ()
+        if xpath == ".//a[@role='link']": # the profile picture & the name
+            return [ FakeElement (self.browser, self.request, "link", "avatar"), FakeElement (self.browser, self.request, "link", self.request["name"]) ]
+        element = self._find (xpath)
+        return [ element ] if element else []
+    def find_element_by_xpath (self, xpath: str):
+        from selenium.common.exceptions import NoSuchElementException
+        self.browser.round_trip ()
+        element = self._find (xpath)
+        if element is None:
+            raise NoSuchElementException (xpath)
+        return element
+
+    def get_attribute (self, name: str):
+        self.browser.round_trip ()
+        if name == "href":
+            return f"/groups/bench/user/{self.request['id']}/" if self.kind == "link" else None
+        return self.text
+    def is_displayed (self):
+        self.browser.round_trip ()
+        return not self.request["handled"]
+    def is_enabled (self):
+        self.browser.round_trip ()
+        return True
+    def click (self):
+        self.browser.round_trip ()
+        if self.kind in ["approve", "decline"] and self.request["name"] not in self.browser.ignored:
+            self.request["handled"] = self.kind
+            self.browser.clicks[self.request["name"]] = self.kind
+
+class FakeBrowser:
+    """
+        In-process stand-in for the Chrome WebDriver showing the FB requests page, implements what fb_automation uses.
+        Like the real page, requests load 'page_size' at a time as the page is scrolled to the bottom.
+        Every WebDriver call counts as a round trip to chromedriver & takes 'latency' seconds
+    """
+    w3c = False # so ActionChains uses the simple protocol
+    REQUEST_HEIGHT = 120
+
+    def __init__ (self, requests: list, page_size: int=25, latency: float=0):
+        """ requests is a list of (name, answer) """
+        self.requests = [ {"id": i, "name": name, "answer": answer, "handled": None} for i, (name, answer) in enumerate (requests) ]
+        self.page_size = page_size
+        self.latency = latency
+        self.loaded = 0
+        self.round_trips = 0
+        self.clicks = dict () # name -> approve/decline
+        self.ignored = set () # names of the requests whose clicks FB ignores
+        self.current_url = "about:blank"
+        self.service = SimpleNamespace (process=SimpleNamespace (pid=os.getpid ()))
+
+    def round_trip (self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep (self.latency)
+    def visible (self):
+        return [ r for r in self.requests[:self.loaded] if not r["handled"] ]
+    def height (self):
+        return self.REQUEST_HEIGHT*len (self.visible ())
+
+    def get (self, url: str):
+        self.round_trip ()
+        self.current_url = url
+        self.loaded = min (self.page_size, len (self.requests))
+    def get_cookie (self, name: str):
+        from fb_automation import SESSION_COOKIE
+        self.round_trip ()
+        return {"name": name, "value": "1"} if name == SESSION_COOKIE else None
+    def find_element (self, by: str, value: str):
+        from fb_automation import MAIN_XPATH
+        from selenium.common.exceptions import NoSuchElementException
+        self.round_trip ()
+        if value == MAIN_XPATH:
+            return FakeElement (self, None, "main")
+        raise NoSuchElementException (value)
+    def find_elements_by_xpath (self, xpath: str):
+        from fb_automation import REQUESTS_XPATH
+        self.round_trip ()
+        return [ FakeElement (self, r, "request") for r in self.visible () ] if xpath == REQUESTS_XPATH else []
+    def find_element_by_css_selector (self, selector: str):
+        self.round_trip ()
+        request_id = int (selector.split ("'")[1]) # [attribute='id']
+        return FakeElement (self, self.requests[request_id], "request")
+    def set_script_timeout (self, timeout: float):
+        self.round_trip ()
+    def execute_script (self, script: str, *args):
+        from fb_automation import EXTRACT_REQUESTS_JS
+        self.round_trip ()
+        if script == EXTRACT_REQUESTS_JS:
+            return [ {"id": r["id"], "name": r["name"], "link": f"/groups/bench/user/{r['id']}/", "answer": r["answer"]} for r in self.visible () ]
+        if "scrollTo" in script: # reached the bottom, the next page loads
+            self.loaded = min (self.loaded + self.page_size, len (self.requests))
+            return None
+        if "scrollHeight" in script:
+            return self.height ()
+        if "performance" in script:
+            return {"load": 0, "heap": None}
+        raise NotImplementedError (script)
+    def execute_async_script (self, script: str, *args): # only used to wait for the page to grow
+        self.round_trip ()
+        return self.height ()
+    def execute (self, command: str, params: dict=None): # used by ActionChains
+        self.round_trip ()
+        return {"value": None}
+    def quit (self):
+        pass
@@ -9,14 +9,132 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException, StaleElementReferenceException
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sys import platform
 import json
+import os
+import re
 import time
+import urllib.parse
+import metrics
 
-def create_browser (gui: bool=False):
-    """ Create a browser instance & return it """
+# upper bounds (in seconds) for the waits; every wait finishes as soon as the page is ready
+DEFAULT_WAITS = {
+    "page": 8, # for the group page to load
+    "scroll": 4, # for more requests to load after scrolling to the bottom
+    "click": 3 # for a button to become clickable & for a request to go away after it is clicked
+}
+MAIN_XPATH = "//div[@role = 'main']"
+SESSION_COOKIE = "c_user" # FB sets this cookie (to the user's ID) only when logged in
+LOGGED_OUT_URLS = ["/login", "/checkpoint"] # FB redirects to these when the session is no longer valid
+REQUESTS_XPATH = "//div[@role = 'main']/div/div[3]/*" # every child is a pending request
+APPROVE_XPATH = ".//span[text()[contains(., 'Approve')]]" # the approve button, relative to the request
+DECLINE_XPATH = ".//span[text()[contains(., 'Decline')]]" # the decline button, relative to the request
+QUESTION_TEXT = "Send an email from" # the relevant question; TODO: put into config.json
+USER_ID_REGEX = re.compile (r"/user/(\d+)|[?&]id=(\d+)") # the FB user ID in a link to a requester's profile
+REQUEST_ATTRIBUTE = "data-sv-request" # attribute the extraction script tags every request with, to find its buttons later
+
+# used by the lean mode of the browser, we only need the text & buttons of the requests list
+LEAN_BLOCKED_URLS = [
+    "*.woff", "*.woff2", "*.ttf", "*.otf", # fonts
+    "*.mp4", "*.webm", "*.m4a", "*.mp3", "*.m3u8", # media
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico", # images not caught by the content setting, eg. in CSS
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*connect.facebook.net*" # third party & tracking scripts
+]
+LEAN_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.managed_default_content_settings.media_stream": 2,
+    "profile.managed_default_content_settings.plugins": 2,
+    "profile.managed_default_content_settings.geolocation": 2
+}
+LEAN_ARGS = [
+    "--blink-settings=imagesEnabled=false",
+    "--js-flags=--max-old-space-size=256", # cap the JS heap of the renderer (in MB)
+    "--renderer-process-limit=1",
+    "--disable-site-isolation-trials", # site isolation spawns a renderer per site
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--mute-audio"
+]
+
+# resolves with the new scroll height as soon as the page grows, or after the timeout if nothing more loads
+WAIT_FOR_HEIGHT_CHANGE_JS = """
+const [lastHeight, timeout, done] = arguments
+if (document.body.scrollHeight !== lastHeight) {
+    return done(document.body.scrollHeight)
+}
+let timer = null
+const observer = new MutationObserver(() => {
+    if (document.body.scrollHeight !== lastHeight) {
+        finish()
+    }
+})
+const finish = () => {
+    observer.disconnect()
+    clearTimeout(timer)
+    done(document.body.scrollHeight)
+}
+observer.observe(document.body, { childList: true, subtree: true, attributes: true })
+timer = setTimeout(finish, timeout*1000)
+"""
+
+# extracts the name & answer of every request in one round trip to the browser; mirrors the XPaths used in view_requests
+EXTRACT_REQUESTS_JS = """
+const [requestsXPath, question, attribute] = arguments
+const hasText = (el, text) => Array.from(el.childNodes).some(n => n.nodeType === Node.TEXT_NODE && n.nodeValue.includes(text))
+const snapshot = document.evaluate(requestsXPath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null)
+const requests = []
+for (let i = 0; i < snapshot.snapshotLength; i++) {
+    const element = snapshot.snapshotItem(i)
+    const links = element.querySelectorAll("a[role='link']")
+    const spans = Array.from(element.querySelectorAll("span"))
+    if (links.length < 2 || !spans.some(s => hasText(s, "Approve")) || !spans.some(s => hasText(s, "Decline"))) {
+        continue
+    }
+    const ques = Array.from(element.querySelectorAll("*")).find(el => hasText(el, question))
+    const ans = ques && ques.nextElementSibling ? ques.nextElementSibling.innerText : null
+    element.setAttribute(attribute, i)
+    requests.push({ id: i, name: links[1].innerHTML, link: links[1].getAttribute("href"), answer: ans })
+}
+return requests
+"""
+
+class LazyElement:
+    """ Handle to a button of a request extracted by EXTRACT_REQUESTS_JS; only looked up in the browser when used """
+    def __init__ (self, browser: webdriver.Chrome, request_id: int, xpath: str):
+        self.browser = browser
+        self.request_id = request_id
+        self.xpath = xpath
+        self.element = None
+    def resolve (self):
+        """ Find the actual element """
+        if self.element is None:
+            request = self.browser.find_element_by_css_selector (f"[{REQUEST_ATTRIBUTE}='{self.request_id}']")
+            self.element = request.find_element_by_xpath (self.xpath)
+        return self.element
+    def click (self):
+        self.resolve ().click ()
+
+def resolve (element):
+    """ The WebElement behind an element or a LazyElement """
+    return element.resolve () if isinstance (element, LazyElement) else element
+
+def create_browser (gui: bool=False, profile_dir: str=None, lean: bool=False):
+    """ 
+        Create a browser instance & return it.
+        If a profile directory is given, the session (cookies etc.) is kept there, so we stay logged in across restarts.
+        A lean browser does not load images, media, fonts or third party scripts & uses less memory
+    """
     
     options = webdriver.ChromeOptions()
+    if profile_dir:
+        profile_dir = os.path.abspath (profile_dir)
+        os.makedirs (profile_dir, exist_ok=True)
+        for lock in ["SingletonLock", "SingletonCookie", "SingletonSocket"]: # left behind if Chrome was killed, Chrome refuses to start if present
+            if os.path.lexists (os.path.join (profile_dir, lock)):
+                os.remove (os.path.join (profile_dir, lock))
+        options.add_argument('--user-data-dir=' + profile_dir)
     options.add_argument('--ignore-certificate-errors')
     options.add_argument("--test-type")
     options.add_argument('--no-sandbox')
@@ -25,9 +143,53 @@ def create_browser (gui: bool=False):
         options.add_argument('--headless') # comment this line for GUI
         options.add_argument('--disable-gpu') # comment this line for GUI
     prefs = {"profile.default_content_setting_values.notifications": 2}
+    if lean:
+        prefs.update (LEAN_PREFS)
+        for arg in LEAN_ARGS:
+            options.add_argument (arg)
     
     options.add_experimental_option("prefs", prefs)
-    return webdriver.Chrome(options=options)
+    browser = webdriver.Chrome(options=options)
+    if lean: # block what the content settings can't
+        browser.execute_cdp_cmd ("Network.enable", {})
+        browser.execute_cdp_cmd ("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+    return browser
+
+def process_tree_rss (pid: int):
+    """ Total resident memory (in bytes) of a process & all its descendants; None if it can't be read (only works on Linux) """
+    if not platform.startswith ("linux"):
+        return None
+    children = dict () # parent pid -> child pids
+    for entry in os.listdir ("/proc"):
+        if not entry.isdigit ():
+            continue
+        try:
+            with open (f"/proc/{entry}/stat") as f:
+                ppid = int (f.read ().rsplit (")", 1)[1].split ()[1]) # the name may have spaces, so split after it
+        except (OSError, IndexError, ValueError): # the process exited
+            continue
+        children.setdefault (ppid, []).append (int (entry))
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop ()
+        pids.extend (children.get (current, []))
+        try:
+            with open (f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith ("VmRSS:"):
+                        total += int (line.split ()[1])*1024
+        except OSError:
+            continue
+    return total
+def browser_stats (browser: webdriver.Chrome):
+    """ How long the current page took to load (in seconds), the page's JS heap & the memory used by the browser (in bytes) """
+    stats = browser.execute_script ("""
+        const t = performance.timing
+        return { load: (t.loadEventEnd - t.navigationStart)/1000, heap: performance.memory ? performance.memory.usedJSHeapSize : null }
+    """)
+    stats["rss"] = process_tree_rss (browser.service.process.pid) # chromedriver is the parent of all of Chrome's processes
+    return stats
         
 
 def fb_login (browser: webdriver.Chrome, config: dict):
@@ -47,55 +209,65 @@ def fb_login (browser: webdriver.Chrome, config: dict):
     time.sleep(1)
     submit_element = browser.find_element_by_id('loginbutton')
     submit_element.click()
+    WebDriverWait(browser, 10).until(lambda _: browser.get_cookie (SESSION_COOKIE) is not None) # wait for the session to start
 
 def is_fb_logged_in (browser: webdriver.Chrome):
-    """ Tries to locate the requests div, if it is found, then we're authenticated successfully """
-    try:
-        browser.find_element_by_xpath ("//*[text()[contains(., 'Manage group')]]")
-        return True
-    except:
+    """ Checks for the session cookie & that FB hasn't redirected to the login page; must be on a FB page already """
+    if any (path in browser.current_url for path in LOGGED_OUT_URLS):
         return False
+    return browser.get_cookie (SESSION_COOKIE) is not None
+
+def get_waits (config: dict):
+    """ The wait bounds, config["waits"] overrides the defaults """
+    return { **DEFAULT_WAITS, **config.get ("waits", {}) }
 
-def scroll_to_bottom (browser: webdriver.Chrome):
-    SCROLL_PAUSE_TIME = 4
+@metrics.timed ("fb_scroll_seconds")
+def scroll_to_bottom (browser: webdriver.Chrome, timeout: float=DEFAULT_WAITS["scroll"]):
+    """ Scroll till no more requests load; after every scroll, waits at most 'timeout' seconds for the page to grow """
+    browser.set_script_timeout (timeout + 5)
     # Get scroll height
     last_height = browser.execute_script("return document.body.scrollHeight")
     while True:
         # Scroll down to bottom
         browser.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
-        # Wait to load page
-        time.sleep(SCROLL_PAUSE_TIME)
+        # Wait for the page to load more, returns as soon as the height changes
+        new_height = browser.execute_async_script (WAIT_FOR_HEIGHT_CHANGE_JS, last_height, timeout)
 
         # Calculate new scroll height and compare with last scroll height
-        new_height = browser.execute_script("return document.body.scrollHeight")
         if new_height == last_height:
             break
         last_height = new_height
 
-def view_requests (browser: webdriver.Chrome, config: dict):
-    """ Returns the pending requests; ignores requests that have pending answers; config["group_url"] must be set """
-    time.sleep (1)
+def load_group_page (browser: webdriver.Chrome, config: dict, waits: dict):
+    """ Open the group's requests page; returns whether we're logged in """
     browser.get(config["group_url"]) # load the group url in the browser
-    time.sleep (3)
+    if not is_fb_logged_in (browser):
+        return False
 
-    element_present = EC.presence_of_element_located((By.XPATH, "//div[@role = 'main']"))
-    WebDriverWait(browser, 8).until(element_present)
-    time.sleep (1)
+    element_present = EC.presence_of_element_located((By.XPATH, MAIN_XPATH))
+    WebDriverWait(browser, waits["page"]).until(element_present)
+    return True
 
-    if not is_fb_logged_in(browser):
+@metrics.timed ("fb_view_requests_seconds")
+def view_requests (browser: webdriver.Chrome, config: dict):
+    """ Returns the pending requests; ignores requests that have pending answers; config["group_url"] must be set """
+    waits = get_waits (config)
+
+    if not load_group_page (browser, config, waits):
+        print ("[FB] not logged in, logging in...") 
         fb_login(browser, config)
-        time.sleep (1)
-        browser.get(config["group_url"]) # load the group url in the browser
-        time.sleep (3)
+        if not load_group_page (browser, config, waits):
+            raise Exception ("failed to log in to FB")
 
-    #print ('got required element')
+    scroll_to_bottom (browser, waits["scroll"]) # ensure we get to all requests
 
-    scroll_to_bottom (browser) # ensure we get to all requests
+    if config.get ("scrape_with_script"): # extract everything in one call, instead of a few calls per request
+        return extract_requests (browser)
 
     requests = list ()
     # the list of requests
-    reqs_list = browser.find_elements_by_xpath ("//div[@role = 'main']/div/div[3]/*")#".//ul[contains(@class, 'uiList')]/child::li/div[contains(@class, 'clearfix')]//div[contains(@class, '_42ef')]")
+    reqs_list = browser.find_elements_by_xpath (REQUESTS_XPATH)#".//ul[contains(@class, 'uiList')]/child::li/div[contains(@class, 'clearfix')]//div[contains(@class, '_42ef')]")
 
     for element in reqs_list:
         name_element = element.find_elements_by_xpath (".//a[@role='link']") # name of the person who has requested
@@ -104,18 +276,19 @@ def view_requests (browser: webdriver.Chrome, config: dict):
         else:
             print(len(name_element))
             continue
-        approve_button = element.find_element_by_xpath (".//span[text()[contains(., 'Approve')]]") # the approve button
-        decline_button = element.find_element_by_xpath (".//span[text()[contains(., 'Decline')]]") # the decline button
+        approve_button = element.find_element_by_xpath (APPROVE_XPATH) # the approve button
+        decline_button = element.find_element_by_xpath (DECLINE_XPATH) # the decline button
         anchor = approve_button#element.find_element_by_xpath (".//div[contains(@class, '_50f8')]") # element, when scrolled to makes the entire request visible
         
         try:
-            ques = element.find_element_by_xpath (".//*[contains(text(), 'Send an email from')]") # the relevant question; TODO: put into config.json
+            ques = element.find_element_by_xpath (f".//*[contains(text(), '{QUESTION_TEXT}')]") # the relevant question
             ans = ques.find_element_by_xpath ("./following-sibling::*").get_attribute("innerText") # answer to the question; innerText returns the text
         except Exception as err: # ignore this request if this answer is not present, as it might still be loading
             ans = None 
         # compile all this info
         obj = {
             "name": name_element.get_attribute("innerHTML"), 
+            "link": name_element.get_attribute("href"), # link to the requester's profile
             "answer": ans,
             "anchor": anchor,
             "approve": approve_button,
@@ -125,36 +298,147 @@ def view_requests (browser: webdriver.Chrome, config: dict):
         requests.append (obj)
     return requests
 
-def handle_requests (browser: webdriver.Chrome, config: dict, validate):
+def extract_requests (browser: webdriver.Chrome):
+    """ Same as the loop in view_requests, but reads all requests with a single script; the buttons are looked up only when clicked """
+    requests = list ()
+    for req in browser.execute_script (EXTRACT_REQUESTS_JS, REQUESTS_XPATH, QUESTION_TEXT, REQUEST_ATTRIBUTE):
+        approve_button = LazyElement (browser, req["id"], APPROVE_XPATH)
+        requests.append ({
+            "name": req["name"],
+            "link": req["link"],
+            "answer": req["answer"],
+            "anchor": approve_button,
+            "approve": approve_button,
+            "decline": LazyElement (browser, req["id"], DECLINE_XPATH)
+        })
+    return requests
+
+def requester_id (config: dict, link: str):
+    """ 
+        A stable identity of a request: the group & the FB user ID in the link to the requester's profile (or the link's path, for profiles with a username).
+        Unlike the name, no one else can have it. None if there's no link
+    """
+    if not link:
+        return None
+    match = USER_ID_REGEX.search (link)
+    user = (match.group (1) or match.group (2)) if match else urllib.parse.urlparse (link).path
+    return config["group_url"] + "#" + user
+
+def handle_requests (browser: webdriver.Chrome, config: dict, validate, clicked=None, scraped=None):
     """
         Goes over all pending requests & based on the 'validate' function accepts/rejects them.
-        Also, automatically re-logs in if logged out. 
+        Also, automatically re-logs in if logged out (see view_requests). 
         Parameters
         ----------
         config : dict
             The credentials & config. Requires config["email"], config["password"] and config["group_url"] to be set
         validate : lambda
-            Function to validate the name & answer of the request, return True or False
+            Function to validate the requester (see requester_id), name & answer of the request, return True or False
+        clicked : lambda
+            Optional, called with the requester, name & answer of every request once its verdict has been clicked
+        scraped : lambda
+            Optional, called with the group url & the requesters of all the pending requests once they've been read
+        Returns
+        -------
+        The number of requests approved or declined
     """
-    if not is_fb_logged_in (browser): # log in if not already
-        print ("[FB] not logged in, logging in...") 
-        fb_login (browser, config)
     reqs = view_requests (browser, config) # view the pending requests
+    if scraped:
+        scraped (config["group_url"], [ requester_id (config, req["link"]) for req in reqs if req["link"] ])
    
     print (f"[FB] got {len(reqs)} requests")
+    stats = browser_stats (browser)
+    metrics.inc ("fb_requests_seen_total", len(reqs))
+    print (f"[FB] page loaded in {stats['load']:.1f}s, browser using {(stats['rss'] or 0)/2**20:.0f}MB, page JS heap {(stats['heap'] or 0)/2**20:.0f}MB")
 
-    for req in reqs:
+    waits = get_waits (config)
+    if config.get ("pipeline"): # validate all the requests at once & click as the verdicts come in
+        verdicts = validate_concurrently (config, reqs, validate, config.get ("validate_workers", 4))
+    else:
+        verdicts = ( (req, validate (requester_id (config, req["link"]), req["name"], req["answer"])) for req in reqs )
+    handled = 0
+    for req, validated in verdicts:
         name = req["name"]
-        
-        ActionChains(browser).move_to_element(req["anchor"]).perform() # make approve button visible
-        time.sleep (1) # sleep for a few seconds before any action
-        
-        validated = validate (name, req["answer"])
+        if validated not in (True, False): # ignore
+            continue
+
+        ActionChains(browser).move_to_element(resolve (req["anchor"])).perform() # make approve button visible
         if validated == True: # if validation succeeded, accept
             print (f"[FB] approving user: {name}")
-            req["approve"].click ()
-        elif validated == False: # decline otherwise
+            with metrics.timed ("fb_click_seconds", action="approve"):
+                confirmed = click (browser, resolve (req["approve"]), waits["click"])
+            metrics.inc ("fb_clicks_total", action="approve")
+        else: # decline otherwise
             print (f"[FB] rejecting user: {name}")
-            req["decline"].click ()
-        else: # ignore
-            pass
+            with metrics.timed ("fb_click_seconds", action="decline"):
+                confirmed = click (browser, resolve (req["decline"]), waits["click"])
+            metrics.inc ("fb_clicks_total", action="decline")
+        if not confirmed: # FB didn't take the click, the verdict stays remembered for the next cycle
+            metrics.inc ("fb_clicks_unconfirmed_total")
+            continue
+        if clicked:
+            clicked (requester_id (config, req["link"]), name, req["answer"])
+        handled += 1
+    return handled
+
+def validate_concurrently (config: dict, reqs: list, validate, workers: int):
+    """
+        Validate the requests on a pool of threads, yielding every request with its verdict as soon as it's in,
+        so the browser clicks while the rest are still being validated.
+        If the caller stops early, the validations that haven't started are cancelled;
+        ones already done are in the journal & get clicked next cycle
+    """
+    stage = metrics.registry.stage ()
+    def run (req):
+        metrics.registry.set_stage (stage) # count towards the FB stage
+        return validate (requester_id (config, req["link"]), req["name"], req["answer"])
+
+    executor = ThreadPoolExecutor (max_workers=workers, thread_name_prefix="validate")
+    futures = { executor.submit (run, req): req for req in reqs }
+    try:
+        for future in as_completed (futures):
+            yield futures[future], future.result ()
+    finally:
+        for future in futures:
+            future.cancel ()
+        executor.shutdown (wait=True)
+
+def handle_groups (browser: webdriver.Chrome, groups: list, validate, clicked=None, scraped=None):
+    """
+        Handle the pending requests of several groups in turn with the same browser.
+        A group that fails is skipped till the next run, so it doesn't hold up the others; raises only if every group failed.
+        Returns the number of requests approved or declined across the groups
+    """
+    handled = 0
+    failures = 0
+    for group in groups:
+        try:
+            handled += handle_requests (browser, group, validate, clicked, scraped)
+        except Exception as error:
+            failures += 1
+            print (f"[FB] failed to handle requests of {group['group_url']}: {error}")
+            metrics.inc ("fb_group_failures_total", group=group.get ("name", group["group_url"]))
+            if failures == len (groups):
+                raise
+    return handled
+
+def is_gone (element):
+    """ Whether the element has been removed from the page or hidden """
+    try:
+        return not element.is_displayed ()
+    except StaleElementReferenceException:
+        return True
+def click (browser: webdriver.Chrome, button, timeout: float=DEFAULT_WAITS["click"]):
+    """ 
+        Click the button once it is clickable & wait (at most 'timeout' seconds) for it to go away, i.e. for FB to register the click.
+        Returns whether it went away
+    """
+    WebDriverWait(browser, timeout).until(lambda _: button.is_displayed () and button.is_enabled ())
+    button.click ()
+    try:
+        WebDriverWait(browser, timeout).until(lambda _: is_gone (button))
+        return True
+    except TimeoutException:
+        print ("[FB] request still visible after clicking, moving on")
+        return False
+
@@ -3,16 +3,78 @@ App specific wrapper around the GMail API
 @author: Adhiraj Singh
 
 """
+import datetime
+import json
 import pickle
 import os
 import base64
+import threading
+import time
+import urllib.request
 from email.mime.text import MIMEText
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from rate_limit import QuotaLimiter, is_retryable
+import metrics
+
+# quota units each call costs, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "messages.send": 100,
+    "history.list": 2,
+    "getProfile": 1
+}
+limiter = QuotaLimiter () # shared by every GMail call the app makes
+DISCOVERY_FILE = "./data/gmail_v1_discovery.json" # cached copy of the GMail API's discovery document, delete it to pick up a newer version
+DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+REFRESH_MARGIN = 5*60 # seconds before the access token expires to refresh it
+discovery = None # the parsed discovery document, shared by every service built
+
+def set_quota (units_per_second: float):
+    """ Change the rate at which quota units are spent across all GMail calls """
+    global limiter
+    limiter = QuotaLimiter (units_per_second)
+def execute (request, method: str, count: int=1):
+    """ Execute a request (or a batch of 'count' requests) once the rate limiter allows it """
+    metrics.inc ("gmail_api_calls_total", count, method=method)
+    with metrics.timed ("gmail_api_seconds", method=method):
+        return limiter.execute (request, QUOTA_UNITS[method]*count)
 
 def get_gmail_service (client_secret_file: str, access_token_file: str):
+    """ Authenticate with GMail & return the service """
+    return build_service (get_credentials (client_secret_file, access_token_file))
+def build_service (creds):
+    """ 
+        A new GMail service using the given credentials; each thread needs its own service as they're not thread safe.
+        Built from the cached discovery document, so no thread waits on fetching & parsing it
+    """
+    from googleapiclient.discovery import build_from_document
+    return build_from_document (discovery_document (), credentials=creds)
+def discovery_document ():
+    """ The GMail API's discovery document, read from DISCOVERY_FILE; it's created from the copy bundled with googleapiclient or downloaded the first time """
+    global discovery
+    if discovery is None:
+        if not os.path.exists (DISCOVERY_FILE):
+            try:
+                from googleapiclient.discovery_cache import get_static_doc # only bundled since googleapiclient 2.0
+                doc = get_static_doc ("gmail", "v1")
+            except ImportError:
+                doc = None
+            if doc is None:
+                with urllib.request.urlopen (DISCOVERY_URL) as response:
+                    doc = response.read ().decode ("utf-8")
+            directory = os.path.dirname (DISCOVERY_FILE)
+            if directory:
+                os.makedirs (directory, exist_ok=True)
+            with open (DISCOVERY_FILE + ".tmp", "w") as f:
+                f.write (doc)
+            os.replace (DISCOVERY_FILE + ".tmp", DISCOVERY_FILE)
+        with open (DISCOVERY_FILE, "r") as f:
+            discovery = json.loads (f.read ())
+    return discovery
+def get_credentials (client_secret_file: str, access_token_file: str):
     """ Authenticate with GMail. Most of the code from https://developers.google.com/gmail/api/quickstart/python """
 
     SCOPES = ['https://mail.google.com/']
@@ -27,27 +89,143 @@ def get_gmail_service (client_secret_file: str, access_token_file: str):
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow # only needed the very first time
             flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, SCOPES)
             creds = flow.run_local_server(port=8000)
         # Save the credentials for the next run
-        with open(access_token_file, 'wb') as token:
-            pickle.dump(creds, token)
-    return build('gmail', 'v1', credentials=creds)
+        save_credentials (creds, access_token_file)
+    return creds
+def save_credentials (creds, access_token_file: str):
+    with open(access_token_file, 'wb') as token:
+        pickle.dump(creds, token)
+def refresh_in_background (creds, access_token_file: str, margin: float=REFRESH_MARGIN):
+    """ 
+        Refresh the credentials on a background thread 'margin' seconds before they expire.
+        Every service built with them sees the new token, so no GMail call waits on a refresh
+    """
+    from google.auth.transport.requests import Request
+    def loop ():
+        while creds.expiry:
+            wait = (creds.expiry - datetime.datetime.utcnow ()).total_seconds () - margin # expiry is in UTC
+            time.sleep (max (wait, 0))
+            try:
+                creds.refresh (Request ())
+                save_credentials (creds, access_token_file)
+            except Exception as err: # the token is still valid for a while, try again
+                print (f"[GMail] failed to refresh access token: {err}")
+                time.sleep (30)
+    thread = threading.Thread (target=loop, name="token-refresh", daemon=True)
+    thread.start ()
+    return thread
+HEADERS_TO_EXTRACT = ["Subject", "From", "To", "Message-ID"] # the only headers the app looks at
+GET_BATCH_SIZE = 50 # max GETs in one HTTP batch request, GMail rate limits batches larger than this
+MODIFY_BATCH_SIZE = 1000 # max IDs batchModify accepts in a single call
+FETCH_PAGE_SIZE = 100 # emails fetched per page; smaller pages mean the first emails can be handled sooner
+LIST_PAGE_SIZE = 500 # max IDs messages.list returns in one call
+
 def read_email (service, mID: str):
     """ Mark an email read """
-    service.users().messages().modify(userId='me', id=mID, body={"removeLabelIds": ['UNREAD']}).execute()
+    execute (service.users().messages().modify(userId='me', id=mID, body={"removeLabelIds": ['UNREAD']}), "messages.modify")
+def read_emails (service, mIDs: list):
+    """ Mark many emails read, uses one batchModify call for every 1000 emails """
+    for i in range (0, len(mIDs), MODIFY_BATCH_SIZE):
+        body = {"ids": mIDs[i:i+MODIFY_BATCH_SIZE], "removeLabelIds": ['UNREAD']}
+        execute (service.users().messages().batchModify(userId='me', body=body), "messages.batchModify")
+def get_messages_metadata (service, mIDs: list):
+    """ Fetch the relevant headers of the given message IDs using batched requests; returns the extracted messages in the same order """
+    results = dict ()
+    pending = list (mIDs)
+    attempt = 0
+    while pending:
+        retry = [] # the requests in the batch that were throttled
+        def on_response (request_id, response, exception):
+            if exception is None:
+                results[request_id] = extract_relevant (response)
+            elif isinstance (exception, HttpError) and exception.resp.status == 404: # message was deleted since it was listed
+                pass
+            elif is_retryable (exception) and attempt < limiter.max_retries:
+                retry.append (request_id)
+            else:
+                raise exception
+
+        for i in range (0, len(pending), GET_BATCH_SIZE):
+            chunk = pending[i:i+GET_BATCH_SIZE]
+            batch = service.new_batch_http_request (callback=on_response)
+            for mID in chunk:
+                request = service.users().messages().get(userId='me', id=mID, format='metadata', metadataHeaders=HEADERS_TO_EXTRACT)
+                batch.add (request, request_id=mID)
+            execute (batch, "messages.get", len(chunk))
+        if retry: # back off & retry only the throttled requests
+            limiter.throttled ()
+            limiter.backoff (attempt)
+            attempt += 1
+        pending = retry
+    return [ results[mID] for mID in mIDs if mID in results ]
+def gmail_fetch_pages (service, q: str, page_size: int=FETCH_PAGE_SIZE):
+    """ 
+        Generator that fetches the emails fitting the query one page at a time, yielding each page's emails as soon as they're fetched.
+        IDs are listed LIST_PAGE_SIZE at a time as the pages are consumed; the caller must not change the emails in ways that
+        take them out of the query (eg. marking them read for an is:unread query) till it's done paging, as that shifts the later pages
+    """
+    page_token = None
+    while True:
+        request = service.users().messages().list(userId='me', q=q, includeSpamTrash=True, maxResults=LIST_PAGE_SIZE, pageToken=page_token)
+        results = execute (request, "messages.list")
+        mIDs = [ mID['id'] for mID in results.get('messages', []) ]
+        for i in range (0, len(mIDs), page_size):
+            yield get_messages_metadata (service, mIDs[i:i+page_size])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
 def gmail_fetch (service, q: str):
     """ Fetch all emails fitting the query """
-    results = service.users().messages().list(userId='me', q=q, includeSpamTrash=True).execute()
-    messageIDs = results.get('messages', [])
-
-    messages = []
-    for mID in messageIDs:
-        msg = service.users().messages().get(userId='me', id=mID['id']).execute()
-        messages.append (extract_relevant(msg)) # extract the relevant part & add to the list
-    return messages
+    return [ message for page in gmail_fetch_pages (service, q) for message in page ]
+def get_history_id (service):
+    """ The ID of the latest change to the mailbox """
+    return execute (service.users().getProfile(userId='me'), "getProfile")['historyId']
+def gmail_history (service, history_id: str):
+    """ 
+        IDs of all messages added to the mailbox since the given history ID & the latest history ID.
+        Returns None if the history ID has expired (GMail only keeps about a week of history)
+    """
+    mIDs = dict () # ordered set, the same message can be in multiple records
+    page_token = None
+    while True:
+        try:
+            request = service.users().history().list(userId='me', startHistoryId=history_id, historyTypes=['messageAdded'], pageToken=page_token)
+            results = execute (request, "history.list")
+        except HttpError as err:
+            if err.resp.status == 404: # history ID too old
+                return None
+            raise
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                mIDs[added['message']['id']] = True
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return list (mIDs), results['historyId']
+def gmail_sync (service, q: str, history_id: str=None, page_size: int=FETCH_PAGE_SIZE):
+    """ 
+        Fetch unread emails received since the given history ID. 
+        If there's no history ID or it has expired, falls back to fetching all emails fitting the query.
+        Returns a generator of pages of emails (fetched lazily) & the history ID to sync from next time
+    """
+    history = gmail_history (service, history_id) if history_id else None
+    if history is None:
+        latest_id = get_history_id (service) # note the ID before the query, so nothing received during the query is missed next time
+        return gmail_fetch_pages (service, q, page_size), latest_id
+    mIDs, latest_id = history
+    return history_pages (service, mIDs, page_size), latest_id
+def history_pages (service, mIDs: list, page_size: int=FETCH_PAGE_SIZE):
+    """ Generator that fetches the given emails one page at a time, skipping the ones that aren't relevant """
+    for i in range (0, len(mIDs), page_size):
+        messages = get_messages_metadata (service, mIDs[i:i+page_size])
+        messages = [ m for m in messages if 'UNREAD' in m['labels'] and 'SENT' not in m['labels'] ] # only emails we haven't handled & haven't sent ourselves
+        if messages:
+            yield messages
 def extract_name_email (txt):
     """ 
         Extracts the name and email from RFC-2822 encoded email address.
@@ -73,7 +251,7 @@ def send_reply (service, text: str, meta: dict):
     # encode as url safe base64
     raw_message = base64.urlsafe_b64encode(message.as_string().encode("utf-8")).decode('utf-8')
     # mention thread Id to save as reply
-    service.users().messages().send(userId='me', body={'raw': raw_message, 'thread_id': meta["thread_id"]}).execute()
+    execute (service.users().messages().send(userId='me', body={'raw': raw_message, 'thread_id': meta["thread_id"]}), "messages.send")
 def send_email (service, address: str, subject: str, text: str):
     """  Sends to an email with the given text to the specified address """
     message = MIMEText (text)
@@ -83,18 +261,54 @@ def send_email (service, address: str, subject: str, text: str):
     # encode as url safe base64
     raw_message = base64.urlsafe_b64encode(message.as_string().encode("utf-8")).decode('utf-8')
     # mention thread Id to save as reply
-    service.users().messages().send(userId='me', body={'raw': raw_message}).execute()
+    execute (service.users().messages().send(userId='me', body={'raw': raw_message}), "messages.send")
 
 def extract_relevant (msg):
     """ Extracts relevant (to the app) headers & info from a GMail message """
-    headers_to_extract = set (["subject", "from", "message-id"])
+    headers_to_extract = set ( map(str.lower, HEADERS_TO_EXTRACT) )
     headers = msg["payload"]["headers"]
     
     data = dict ()
     data ["id"] = msg ["id"]
     data ["thread_id"] = msg ["threadId"]
+    data ["labels"] = msg.get ("labelIds", [])
     for header in headers:
         name = header["name"].lower()
         if name in headers_to_extract:
             data [name] = header ["value"]
-    return data
\ No newline at end of file
+    return data
+
+def test_history_sync ():
+    """ Checks the incremental sync against a fake mailbox """
+    from fakes import FakeGmailService
+    service = FakeGmailService (page_size=2)
+    q = "is:unread subject:Join+FB+Group"
+    def sync (history_id=None):
+        pages, history_id = gmail_sync (service, q, history_id, page_size=2)
+        return [ message for page in pages for message in page ], history_id
+    service.add_message ("Old <old.one_ug21@ashoka.edu.in>", "Join FB Group")
+
+    messages, history_id = sync () # no checkpoint, full query
+    assert [ m['from'] for m in messages ] == ["Old <old.one_ug21@ashoka.edu.in>"]
+    read_emails (service, [ m['id'] for m in messages ])
+
+    for i in range (5): # spans multiple pages of history
+        service.add_message (f"New <new.{i}_ug21@ashoka.edu.in>", "Join FB Group")
+    send_email (service, "old.one_ug21@ashoka.edu.in", "Re: Join FB Group", "hello") # our own email should not show up
+    messages, history_id = sync (history_id)
+    assert len (messages) == 5 and all (m['from'].startswith ("New") for m in messages)
+
+    messages, history_id = sync (history_id) # nothing new
+    assert messages == []
+
+    service.add_message ("Late <late.one_ug21@ashoka.edu.in>", "Join FB Group")
+    service.expire_history ()
+    pages, _ = gmail_sync (service, q, history_id, page_size=2) # checkpoint expired, falls back to the query
+    assert [ len (page) for page in pages ] == [2, 2, 2] # fetched across pages
+
+    round_trips = service.round_trips
+    next (gmail_fetch_pages (service, q, page_size=2)) # the first page comes after listing one page of IDs, however big the backlog
+    assert service.round_trips - round_trips == 2
+
+if __name__ == "__main__":
+    test_history_sync ()
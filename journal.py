@@ -0,0 +1,143 @@
+"""
+Local, append-only journal of where every email & FB request is in its handling,
+so a restart picks up where the last run stopped instead of redoing (or losing) work
+
+"""
+import csv
+import os
+import time
+import threading
+
+EMAIL = "email"
+REQUEST = "request"
+
+FETCHED = "fetched" # email: the reply is being sent
+REPLIED = "replied" # email: replied to, still to be marked read
+MARKED_READ = "marked-read" # email: done
+VALIDATED = "validated" # FB request: the verdict is in (& the code redeemed if approved), still to be clicked
+CLICKED = "clicked" # FB request: done
+DROPPED = "dropped" # the email or request went away before it was done
+DONE = set ([MARKED_READ, CLICKED, DROPPED])
+
+class WorkJournal:
+    """
+        CSV file with an in-memory index of the items that are not done yet.
+        Every row is (kind, id, state, verdict, time, tries); rows are only ever appended, the last state of an item wins.
+        'time' is when the item was first recorded & 'tries' the number of times in a row it was recorded in its state (eg. replies attempted).
+        On start the file is replayed & rewritten with just the unfinished items, dropping ones older than max_age
+        (eg. requests withdrawn before they could be clicked). While running, every item adds a row per state it goes through,
+        so the file is rewritten again once it has COMPACT_ROWS more rows than there are unfinished items
+    """
+
+    FIELDS = ["kind", "id", "state", "verdict", "time", "tries"]
+    COMPACT_ROWS = 10000
+
+    def __init__ (self, file: str, max_age: float=7*24*60*60):
+        self.file = file
+        self.entries = dict () # (kind, id) -> (state, verdict, time, tries) of unfinished items
+        self.lock = threading.Lock ()
+        if os.path.exists (file):
+            self._load (time.time () - max_age)
+        self._compact ()
+
+    def _load (self, oldest: float):
+        """ Replay the file into the index """
+        with open (self.file, newline="") as f:
+            for row in csv.DictReader (f):
+                tries = row.get ("tries") # not in journals written before tries were counted
+                self._index (row["kind"], row["id"], row["state"], row["verdict"], int (row["time"]), int (tries) if tries else None)
+        self.entries = { key: entry for key, entry in self.entries.items () if entry[2] >= oldest }
+    def _index (self, kind: str, id: str, state: str, verdict: str, when: int, tries: int=None):
+        """ Update the item's entry & return it; tries is counted if not given """
+        if state in DONE:
+            return self.entries.pop ((kind, id), None)
+        previous = self.entries.get ((kind, id))
+        if previous:
+            when = previous[2] # keep the time the item was first seen, so retrying doesn't keep it from ageing out
+        if tries is None:
+            tries = previous[3] + 1 if previous and previous[0] == state else 1
+        entry = self.entries[(kind, id)] = (state, verdict, when, tries)
+        return entry
+    def _compact (self):
+        """ Rewrite the file with only the unfinished items """
+        directory = os.path.dirname (self.file)
+        if directory:
+            os.makedirs (directory, exist_ok=True)
+        tmp_file = self.file + ".tmp"
+        with open (tmp_file, "w", newline="") as f:
+            writer = csv.writer (f)
+            writer.writerow (self.FIELDS)
+            writer.writerows ([ kind, id, *entry ] for (kind, id), entry in self.entries.items ())
+        os.replace (tmp_file, self.file) # atomic, so a crash never leaves a corrupt journal
+        self.rows = len (self.entries)
+
+    def state (self, kind: str, id: str):
+        """ The state of an unfinished item, None if it is done or was never recorded """
+        entry = self.entries.get ((kind, id))
+        return entry and entry[0]
+    def verdict (self, kind: str, id: str):
+        """ The verdict recorded with the item's state, if any """
+        entry = self.entries.get ((kind, id))
+        return { "true": True, "false": False }.get (entry and entry[1])
+    def tries (self, kind: str, id: str):
+        """ How many times in a row the item has been recorded in its state, 0 if it is done """
+        entry = self.entries.get ((kind, id))
+        return entry[3] if entry else 0
+    def pending (self, kind: str):
+        """ IDs of the unfinished items of a kind """
+        with self.lock:
+            return [ id for k, id in self.entries if k == kind ]
+
+    def record (self, kind: str, ids: list, state: str, verdict: bool=None):
+        """ Record that the given items moved to a state, in one write """
+        if not ids:
+            return
+        now = int (time.time ())
+        verdict = "" if verdict is None else str(verdict).lower ()
+        with self.lock:
+            rows = []
+            for id in ids:
+                entry = self._index (kind, id, state, verdict, now)
+                rows.append ([ kind, id, state, verdict, now, entry[3] if entry and state not in DONE else "" ])
+            with open (self.file, "a", newline="") as f:
+                csv.writer (f).writerows (rows)
+            self.rows += len (rows)
+            if self.rows - len (self.entries) > self.COMPACT_ROWS:
+                self._compact ()
+
+    def __len__ (self):
+        return len (self.entries)
+
+def test_journal ():
+    import tempfile
+    with tempfile.TemporaryDirectory () as directory:
+        file = os.path.join (directory, "journal.csv")
+        journal = WorkJournal (file)
+        journal.record (EMAIL, ["a", "b", "c"], FETCHED)
+        journal.record (EMAIL, ["a", "b"], REPLIED)
+        journal.record (EMAIL, ["a"], MARKED_READ)
+        journal.record (REQUEST, ["Some One:code"], VALIDATED, True)
+        journal.record (REQUEST, ["Other One:junk"], VALIDATED, False)
+        journal.record (REQUEST, ["Other One:junk"], CLICKED)
+
+        journal.record (EMAIL, ["c"], FETCHED) # retried
+        assert journal.tries (EMAIL, "c") == 2 and journal.tries (EMAIL, "b") == 1
+
+        journal = WorkJournal (file) # restart
+        assert journal.tries (EMAIL, "c") == 2
+        assert journal.state (EMAIL, "a") is None and journal.state (EMAIL, "b") == REPLIED and journal.state (EMAIL, "c") == FETCHED
+        assert sorted (journal.pending (EMAIL)) == ["b", "c"]
+        assert journal.verdict (REQUEST, "Some One:code") == True and journal.state (REQUEST, "Other One:junk") is None
+        with open (file) as f:
+            assert len (f.readlines ()) == 1 + len (journal) # only the unfinished items are kept
+
+        journal.COMPACT_ROWS = 4
+        journal.record (EMAIL, ["d", "e", "f"], FETCHED)
+        journal.record (EMAIL, ["d", "e", "f"], MARKED_READ) # more than 4 rows of finished work, rewritten
+        with open (file) as f:
+            assert len (f.readlines ()) == 1 + len (journal)
+
+        assert len (WorkJournal (file, max_age=-1)) == 0 # everything is too old
+
+if __name__ == "__main__":
+    test_journal ()
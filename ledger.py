@@ -0,0 +1,88 @@
+"""
+Local, append-only record of the email addresses that have been issued a code & that have redeemed one.
+Replaces searching the 'Sent' folder of the GMail account every time we need to know if an email was already used.
+
+"""
+import csv
+import os
+import time
+import threading
+
+ISSUED = "issued" # a code was sent to the address
+REDEEMED = "redeemed" # the address's code was used to join the group
+
+class RedemptionLedger:
+    """
+        CSV file with an in-memory index of its contents.
+        Every row is (email, status, timestamp); rows are only ever appended, the last status of an email wins.
+    """
+
+    FIELDS = ["email", "status", "time"]
+
+    def __init__ (self, file: str):
+        self.file = file
+        self.issued = set ()
+        self.redeemed = set ()
+        self.lock = threading.Lock ()
+        self.exists = os.path.exists (file) # if the file does not exist, the ledger must be seeded
+        if self.exists:
+            self._load ()
+
+    def _load (self):
+        """ Read the entire file into the index """
+        with open (self.file, newline="") as f:
+            for row in csv.DictReader (f):
+                self._index (row["email"], row["status"])
+    def _index (self, email: str, status: str):
+        if status == REDEEMED:
+            self.redeemed.add (email)
+        self.issued.add (email) # a redeemed email must have been issued a code too
+    def _append (self, rows: list):
+        """ Append rows to the file, writes the header if the file is new """
+        directory = os.path.dirname (self.file)
+        if directory:
+            os.makedirs (directory, exist_ok=True)
+        with open (self.file, "a", newline="") as f:
+            writer = csv.writer (f)
+            if not self.exists:
+                writer.writerow (self.FIELDS)
+                self.exists = True
+            writer.writerows (rows)
+
+    def seed (self, emails):
+        """ Mark all the given emails as redeemed in one write; used to import history on first start """
+        now = int (time.time ())
+        with self.lock:
+            rows = []
+            for email in set (map (str.lower, emails)):
+                if email not in self.redeemed:
+                    self._index (email, REDEEMED)
+                    rows.append ([email, REDEEMED, now])
+            self._append (rows)
+        return len (rows)
+
+    def is_redeemed (self, email: str):
+        return email.lower () in self.redeemed
+    def is_issued (self, email: str):
+        return email.lower () in self.issued
+
+    def issue (self, email: str):
+        """ Record that a code was sent to the email """
+        email = email.lower ()
+        with self.lock:
+            if email in self.issued:
+                return
+            self._index (email, ISSUED)
+            self._append ([[email, ISSUED, int (time.time ())]])
+    def redeem (self, email: str):
+        """ Record that the email has been used to join; returns False if it was already redeemed """
+        email = email.lower ()
+        with self.lock:
+            if email in self.redeemed:
+                return False
+            self._index (email, REDEEMED)
+            self._append ([[email, REDEEMED, int (time.time ())]])
+            return True
+
+    def __len__ (self):
+        return len (self.redeemed)
@@ -5,46 +5,77 @@ Puts together the 'FB automation' & 'email verification' modules and runs the co
 
 """
 import json
-import time
-import signal
-import traceback 
+from concurrent.futures import ThreadPoolExecutor
 from sys import argv
-from fb_automation import create_browser, handle_requests
 from verification import Verifier
+from scheduler import Scheduler, PeriodicTask
+import metrics
 
+# how often each stage runs (in seconds); a stage runs at its min interval while it has work & backs off to its max when idle
+DEFAULT_SCHEDULE = {
+    "email": {"min_interval": 15, "max_interval": 300},
+    "fb": {"min_interval": 30, "max_interval": 600}
+}
 
 def load_json (filename: str):
     """ loads a JSON stored at given file """
     with open (filename, "r") as f:
         data = f.read ()
     return json.loads (data)
-def close_browser (signum, frame):
-    browser.quit ()
-    exit (0)
 
 config_file = argv[-1] # argument to know where the configuration file is
 
 config = load_json (config_file) # load the config (credentials and all)
-verifier = Verifier (config) # fetches emails, generates codes & validates requests
 
-browser = create_browser (argv[-2] == "gui") # create an instance of a browser
-signal.signal (signal.SIGINT, close_browser) # close on keyboard interrupt (ctrl + c)
+if "metrics" in config: # timings & counts of every stage, see metrics.py
+    metrics.registry.log_file = config["metrics"].get ("log_file")
+    if config["metrics"].get ("port"):
+        metrics.registry.serve (config["metrics"]["port"])
 
-# loop forever & accept requests
-while True:
-    try:
-        print ("fetching emails...")
-        verifier.fetch ()
+# every group overrides the shared FB settings; all groups share the GMail sync, the ledger & the rate limiter of the one verifier
+groups = [ { **config["fb"], **group } for group in config.get ("groups", [ {} ]) ]
+browser_count = min (config["fb"].get ("max_browsers", 1), len (groups))
+scheduler = Scheduler ()
 
-        print ("responding to FB requests...")
-        handle_requests (browser, config["fb"], lambda name, answer : verifier.validate(name, answer))
-        print ("finished cycle")
-    except Exception as error:
-        print (f"exception in cycle: {error}")
-        traceback.print_exc()
+def launch_browser (profile_dir: str):
+    """ Create an instance of a browser, reusing the saved session if any """
+    from fb_automation import create_browser # selenium is only imported by the thread that needs it
+    return create_browser (argv[-2] == "gui", profile_dir, config["fb"].get ("lean", False))
+def on_launched (launch):
+    if launch.exception (): # can't do without the browser
+        print (f"failed to start the browser: {launch.exception ()}")
+        scheduler.stop ()
+def handle_shard (launch, shard: list):
+    from fb_automation import handle_groups
+    return handle_groups (launch.result (), shard, verifier.validate, verifier.clicked, verifier.scraped) # the first run waits for the browser to start
 
-    time.sleep (1*60 + 30) # wait a few minutes before restarting the cycle
+# the browsers start in the background while the verifier is set up & the first emails are handled
+launcher = ThreadPoolExecutor (max_workers=browser_count, thread_name_prefix="browser-launch")
+launches = []
+for i in range (browser_count):
+    profile_dir = config["fb"].get ("profile_dir")
+    if profile_dir and i > 0: # Chrome can't share a profile between instances
+        profile_dir += f"-{i}"
+    launches.append (launcher.submit (launch_browser, profile_dir))
+    launches[-1].add_done_callback (on_launched)
+launcher.shutdown (wait=False)
 
-    
-    
+try:
+    verifier = Verifier (config) # fetches emails, generates codes & validates requests
+except Exception:
+    for launch in launches:
+        launch.add_done_callback (lambda launch: launch.exception () or launch.result ().quit ())
+    raise
 
+schedule = { **DEFAULT_SCHEDULE, **config.get ("schedule", {}) }
+scheduler.on_stop (verifier.close) # send any queued emails
+
+# the email & FB stages run independently, so a slow FB pass does not hold up replying to emails
+scheduler.add (PeriodicTask ("email", verifier.fetch, **schedule["email"]))
+for i, launch in enumerate (launches): # the groups are dealt out to the browsers, every browser goes over its groups in turn
+    scheduler.on_stop (lambda launch=launch: launch.result ().quit ()) # cleanups run in reverse, so the browsers are closed before waiting on queued emails
+
+    name = "fb" if browser_count == 1 else f"fb-{i}"
+    scheduler.add (PeriodicTask (name, lambda launch=launch, shard=groups[i::browser_count]: handle_shard (launch, shard), **schedule["fb"]))
+
+scheduler.run () # loop till stopped (ctrl + c)
@@ -0,0 +1,142 @@
+"""
+Lightweight counters & timing histograms for every stage of the app,
+exposed in the Prometheus text format over HTTP & logged as a JSON line at the end of every cycle
+
+"""
+import http.server
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) # upper bounds (in seconds) of the histogram buckets
+
+def _key (name: str, labels: dict):
+    return (name, tuple (sorted (labels.items ())))
+def _format_labels (labels: tuple, extra: str=""):
+    parts = [ f'{k}="{v}"' for k, v in labels ] + ([ extra ] if extra else [])
+    return "{" + ",".join (parts) + "}" if parts else ""
+
+class Registry:
+    """ Holds all the metrics; every update is a dict operation under a lock, cheap enough to leave on permanently """
+    def __init__ (self):
+        self.counters = dict () # (name, labels) -> value
+        self.histograms = dict () # (name, labels) -> [bucket counts..., sum, count]
+        self.cycle_counts = dict () # stage -> { counter name & labels: value } since the stage's last cycle ended
+        self.local = threading.local () # the stage the current thread is working for
+        self.lock = threading.Lock ()
+        self.log_file = None # JSON cycle logs go to stdout if not set
+
+    def stage (self):
+        return getattr (self.local, "stage", None)
+    def set_stage (self, stage: str):
+        """ Attribute the calling thread's counts to the given stage's cycle """
+        self.local.stage = stage
+
+    def inc (self, name: str, value: float=1, **labels):
+        """ Increment a counter """
+        key = _key (name, labels)
+        stage = self.stage ()
+        with self.lock:
+            self.counters[key] = self.counters.get (key, 0) + value
+            if stage:
+                counts = self.cycle_counts.setdefault (stage, dict ())
+                series = name + _format_labels (key[1])
+                counts[series] = counts.get (series, 0) + value
+    def observe (self, name: str, seconds: float, **labels):
+        """ Record a duration in a histogram """
+        key = _key (name, labels)
+        with self.lock:
+            hist = self.histograms.get (key)
+            if hist is None:
+                hist = self.histograms[key] = [0]*(len(BUCKETS) + 2)
+            for i, bound in enumerate (BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextmanager
+    def timed (self, name: str, **labels):
+        """ Time the block into the histogram 'name' """
+        start = time.perf_counter ()
+        try:
+            yield
+        finally:
+            self.observe (name, time.perf_counter () - start, **labels)
+
+    def end_cycle (self, stage: str, seconds: float, items: int, error: str=None):
+        """ Log a JSON line with the cycle's duration & the counts made during it """
+        self.observe ("stage_seconds", seconds, stage=stage)
+        with self.lock:
+            counts = self.cycle_counts.pop (stage, dict ())
+        line = json.dumps ({"time": round (time.time (), 3), "stage": stage, "seconds": round (seconds, 3), "items": items, "error": error, "counts": counts})
+        if self.log_file:
+            with open (self.log_file, "a") as f:
+                f.write (line + "\n")
+        else:
+            print (line)
+
+    def render (self):
+        """ All metrics in the Prometheus text exposition format """
+        with self.lock:
+            counters = dict (self.counters)
+            histograms = { key: list (hist) for key, hist in self.histograms.items () }
+        lines = []
+        for name in sorted (set (name for name, _ in counters)):
+            lines.append (f"# TYPE {name} counter")
+            lines.extend (f"{name}{_format_labels (labels)} {value}" for (n, labels), value in counters.items () if n == name)
+        for name in sorted (set (name for name, _ in histograms)):
+            lines.append (f"# TYPE {name} histogram")
+            for (n, labels), hist in histograms.items ():
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip (BUCKETS, hist):
+                    cumulative += count
+                    lines.append (name + "_bucket" + _format_labels (labels, 'le="%s"' % bound) + f" {cumulative}")
+                lines.append (name + "_bucket" + _format_labels (labels, 'le="+Inf"') + f" {hist[-1]}")
+                lines.append (f"{name}_sum{_format_labels (labels)} {hist[-2]}")
+                lines.append (f"{name}_count{_format_labels (labels)} {hist[-1]}")
+        return "\n".join (lines) + "\n"
+
+    def serve (self, port: int, host: str="127.0.0.1"):
+        """ Serve the metrics at http://host:port/metrics on a background thread """
+        registry = self
+        class Handler (http.server.BaseHTTPRequestHandler):
+            def do_GET (self):
+                if self.path != "/metrics":
+                    self.send_error (404)
+                    return
+                body = registry.render ().encode ("utf-8")
+                self.send_response (200)
+                self.send_header ("Content-Type", "text/plain; version=0.0.4")
+                self.send_header ("Content-Length", str(len(body)))
+                self.end_headers ()
+                self.wfile.write (body)
+            def log_message (self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer ((host, port), Handler)
+        threading.Thread (target=server.serve_forever, name="metrics", daemon=True).start ()
+        return server
+
+registry = Registry () # the registry used by the whole app
+inc = registry.inc
+observe = registry.observe
+timed = registry.timed
+
+def test_metrics ():
+    r = Registry ()
+    r.set_stage ("email")
+    r.inc ("gmail_api_calls_total", method="messages.list")
+    r.inc ("gmail_api_calls_total", 2, method="messages.get")
+    with r.timed ("gmail_api_seconds", method="messages.list"):
+        pass
+    text = r.render ()
+    assert 'gmail_api_calls_total{method="messages.get"} 2' in text
+    assert 'gmail_api_seconds_bucket{method="messages.list",le="+Inf"} 1' in text
+    assert r.cycle_counts["email"] == {'gmail_api_calls_total{method="messages.list"}': 1, 'gmail_api_calls_total{method="messages.get"}': 2}
+
+if __name__ == "__main__":
+    test_metrics ()
@@ -0,0 +1,60 @@
+"""
+Sends emails on a bounded pool of worker threads so the email & FB loops don't block on GMail round trips
+
+"""
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+import metrics
+
+class Outbox:
+    """
+        Runs GMail calls of the form fn (service, *args) in the background.
+        Every worker builds its own service with service_factory, as the API client is not thread safe.
+        Rate limiting & retries happen in gmail_utils, shared with the rest of the app.
+    """
+    def __init__ (self, service_factory, workers: int=4, max_pending: int=100):
+        self.service_factory = service_factory
+        self.executor = ThreadPoolExecutor (max_workers=workers, thread_name_prefix="outbox")
+        self.local = threading.local ()
+        self.slots = threading.BoundedSemaphore (max_pending) # submitting blocks once this many emails are queued
+        self.pending = set ()
+        self.lock = threading.Lock ()
+
+    def _service (self):
+        if not hasattr (self.local, "service"):
+            self.local.service = self.service_factory ()
+        return self.local.service
+    def _run (self, fn, args, stage: str):
+        metrics.registry.set_stage (stage) # count the calls towards the stage that queued them
+        try:
+            return fn (self._service (), *args)
+        except Exception as err:
+            print (f"[Outbox] failed to send: {err}")
+            traceback.print_exc ()
+            raise
+        finally:
+            self.slots.release ()
+
+    def submit (self, fn, *args):
+        """ Queue fn (service, *args) to be run by a worker; returns the future """
+        self.slots.acquire ()
+        future = self.executor.submit (self._run, fn, args, metrics.registry.stage ())
+        with self.lock:
+            self.pending.add (future)
+        future.add_done_callback (self._done)
+        return future
+    def _done (self, future):
+        with self.lock:
+            self.pending.discard (future)
+
+    def drain (self, futures: list=None, timeout: float=None):
+        """ Wait for the given futures (everything queued so far by default) to finish; returns the number of emails that failed """
+        if futures is None:
+            with self.lock:
+                futures = list (self.pending)
+        done, not_done = wait (futures, timeout=timeout)
+        return len (not_done) + sum (1 for f in done if f.exception () is not None)
+    def close (self):
+        """ Send whatever is queued & stop the workers """
+        self.executor.shutdown (wait=True)
@@ -0,0 +1,74 @@
+"""
+Token bucket rate limiter that keeps GMail API usage under the per-user quota & retries throttled requests
+
+"""
+import random
+import threading
+import time
+from googleapiclient.errors import HttpError
+import metrics
+
+RETRY_STATUSES = set ([429, 500, 502, 503, 504]) # statuses worth retrying after a backoff
+RATE_LIMIT_REASONS = set (["rateLimitExceeded", "userRateLimitExceeded"]) # GMail also throttles using 403s with these reasons
+
+def is_retryable (err: Exception):
+    """ Whether the request failed because of throttling or a transient server error """
+    if not isinstance (err, HttpError):
+        return False
+    if err.resp.status in RETRY_STATUSES:
+        return True
+    return err.resp.status == 403 and any (reason in str(err.content) for reason in RATE_LIMIT_REASONS)
+
+class QuotaLimiter:
+    """
+        Token bucket where the tokens are GMail quota units (see https://developers.google.com/gmail/api/reference/quota).
+        Shared by all threads making GMail calls, so together they stay at, but never above, the quota.
+    """
+    def __init__ (self, units_per_second: float=250, burst: float=None, max_retries: int=6, base_delay: float=1):
+        self.rate = units_per_second
+        self.burst = burst or units_per_second # max tokens the bucket can hold
+        self.max_retries = max_retries
+        self.base_delay = base_delay # the first backoff delay, doubles every retry
+        self.tokens = self.burst
+        self.updated = time.monotonic ()
+        self.lock = threading.Lock ()
+
+    def _refill (self):
+        now = time.monotonic ()
+        self.tokens = min (self.burst, self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+    def acquire (self, units: float):
+        """ Block till the bucket has enough tokens for a call costing the given units """
+        units = min (units, self.burst) # a call costing more than the burst would otherwise never go through
+        while True:
+            with self.lock:
+                self._refill ()
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return
+                wait = (units - self.tokens)/self.rate
+            time.sleep (wait)
+    def throttled (self):
+        """ Empty the bucket after the server says we're going too fast, so the other threads slow down too """
+        with self.lock:
+            self._refill ()
+            self.tokens = min (self.tokens, 0)
+    def backoff (self, attempt: int):
+        """ Sleep for an exponentially increasing, jittered delay """
+        time.sleep (self.base_delay * (2 ** attempt) * (0.5 + random.random ()))
+
+    def execute (self, request, units: float):
+        """ Execute an API request once tokens are available, retrying with exponential backoff on throttling & server errors """
+        attempt = 0
+        while True:
+            self.acquire (units)
+            try:
+                return request.execute ()
+            except HttpError as err:
+                if not is_retryable (err) or attempt >= self.max_retries:
+                    raise
+                print (f"[GMail] request failed with {err.resp.status}, retrying ({attempt+1}/{self.max_retries})")
+                metrics.inc ("gmail_api_retries_total", status=err.resp.status)
+                self.throttled ()
+                self.backoff (attempt)
+                attempt += 1
@@ -0,0 +1,84 @@
+"""
+Runs the stages of the app as independent periodic tasks, each adapting how often it runs to how much work it finds
+
+"""
+import signal
+import threading
+import time
+import traceback
+import metrics
+
+class PeriodicTask:
+    """
+        A stage that is run over & over on its own thread.
+        fn () should return the amount of work it did; the task runs again after min_interval if there was work,
+        otherwise the interval doubles (up to max_interval). Failures back off the same way.
+    """
+    def __init__ (self, name: str, fn, min_interval: float=15, max_interval: float=300):
+        self.name = name
+        self.fn = fn
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.failures = 0 # consecutive failures
+
+    def run_once (self):
+        """ Run the stage & return how long to wait before the next run """
+        start = time.time ()
+        metrics.registry.set_stage (self.name)
+        try:
+            work = self.fn () or 0
+            self.failures = 0
+            if work > 0: # there's a backlog, come back soon
+                self.interval = self.min_interval
+            else:
+                self.interval = min (self.interval*2, self.max_interval)
+            print (f"[{self.name}] finished in {time.time()-start:.1f}s with {work} items, next run in {self.interval:.0f}s")
+            metrics.registry.end_cycle (self.name, time.time () - start, work)
+        except Exception as error:
+            self.failures += 1
+            self.interval = min (self.min_interval * (2 ** self.failures), self.max_interval)
+            print (f"[{self.name}] exception in cycle: {error}, retrying in {self.interval:.0f}s")
+            traceback.print_exc ()
+            metrics.inc ("stage_failures_total", stage=self.name)
+            metrics.registry.end_cycle (self.name, time.time () - start, 0, str(error))
+        return self.interval
+
+class Scheduler:
+    """ Runs periodic tasks till stopped (by SIGINT/SIGTERM or stop ()), then runs the cleanup functions """
+    def __init__ (self):
+        self.tasks = []
+        self.cleanups = []
+        self.stopped = threading.Event ()
+
+    def add (self, task: PeriodicTask):
+        self.tasks.append (task)
+    def on_stop (self, fn):
+        """ Register a function to call on shutdown, they're called in the reverse order of registering """
+        self.cleanups.append (fn)
+    def stop (self, *args):
+        self.stopped.set ()
+
+    def _loop (self, task: PeriodicTask):
+        while not self.stopped.is_set ():
+            interval = task.run_once ()
+            self.stopped.wait (interval) # returns early on stop
+    def run (self):
+        """ Start all the tasks & block till stopped """
+        signal.signal (signal.SIGINT, self.stop) # close on keyboard interrupt (ctrl + c)
+        signal.signal (signal.SIGTERM, self.stop) # close when the container is stopped
+
+        threads = [ threading.Thread (target=self._loop, args=(task,), name=task.name, daemon=True) for task in self.tasks ]
+        for thread in threads:
+            thread.start ()
+        while not self.stopped.is_set ():
+            self.stopped.wait (1) # wait with a timeout so signals are handled promptly
+
+        print ("stopping, waiting for running stages to finish...")
+        for thread in threads:
+            thread.join ()
+        for fn in reversed (self.cleanups):
+            try:
+                fn ()
+            except Exception as error:
+                print (f"exception while stopping: {error}")
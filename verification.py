@@ -3,112 +3,304 @@
 @author: Adhiraj Singh
 
 """
+import itertools
 import json
-import time
+import os
 import re
-import csv
-from aes import encrypt, decrypt
-from gmail_utils import get_gmail_service, gmail_fetch, extract_relevant, extract_name_email, send_reply, read_email, send_email
+from aes import Codec
+from allowlist import EmailAllowlist
+from ledger import RedemptionLedger
+from journal import WorkJournal, EMAIL, REQUEST, FETCHED, REPLIED, MARKED_READ, VALIDATED, CLICKED, DROPPED
+from cache import LRUCache
+from rate_limit import is_retryable
+from outbox import Outbox
+import metrics
+from gmail_utils import get_credentials, refresh_in_background, build_service, set_quota, gmail_fetch_pages, get_messages_metadata, gmail_sync, extract_relevant, extract_name_email, send_reply, read_email, read_emails, send_email
 
-def read_column_of_csv (file, column):
-    with open (file) as csv_file:
-        reader = csv.DictReader (csv_file)
-        rows = [ row[column] for row in reader ]
-        return rows
-    return []
+DROP_AFTER_SCRAPES = 3 # scrapes in a row a validated request must be missing from before it's forgotten
 
 '''
     To ensure that one person can use their email only once to validate a code, we store their emails in a set. 
-    Then, we check if the set contains the email trying to validate, if it does validation fails
+    Then, we check if the set contains the email trying to validate, if it does validation fails.
+    The set is persisted in the 'datafile' (see ledger.py), & is seeded from the 'Sent' folder the first time we run.
 '''
 class Verifier:
     """ 
         Class that can fetch emails, verify the sender, generate validation codes & validate requests.    
     """
     
-    def __init__ (self, config: dict):
-        self.encryption_key = config["encryption_key"] # key used to sign the codes
+    def __init__ (self, config: dict, service_factory=None):
+        """ service_factory returns a new GMail service, by default one is built from the credentials in the config """
+        self.codec = Codec (config["encryption_key"]) # encrypts & decrypts the codes, the key is derived from the encryption key just once
         self.subject_q = config["email_subject"].lower () # the subject that the emails should have
         self.subject_accept = config["accepted_email_subject"]
         self.email_regex = re.compile(config["valid_email_regex"]) # regex to validate an email address
         self.responses = config['responses']
 
-        if "valid_email_list" in config:
-            opts = config["valid_email_list"]
-            valids = read_column_of_csv(opts["file"], opts["column"])
-            self.valid_emails_list = set( filter (lambda x: len(x) > 0, valids) )
-            print (f"read {len(self.valid_emails_list)} valid emails in list")
-        self.last_fetch = None # when was the last fetch
+        sources = config.get ("valid_email_list", []) # one { "file", "column" } or a list of them
+        sources = [ sources ] if isinstance (sources, dict) else sources
+        self.valid_emails_list = EmailAllowlist (sources, config.get ("valid_email_list_check_interval", 30)) # reloaded when the files change
+        print (f"read {len(self.valid_emails_list)} valid emails in list")
+        self.email_verdicts = LRUCache (100000) # email -> (list version, whether it is valid)
+        self.sync_state_file = config.get("sync_state", "./data/sync_state.json") # where the mailbox checkpoint is stored
+        self.history_id = self.load_history_id () # the point in the mailbox's history we've synced up to
 
-        self.service = get_gmail_service (config["client_secret"], config["access_token"]) # gmail service
+        if "gmail_quota_per_second" in config:
+            set_quota (config["gmail_quota_per_second"]) # quota units/second shared by all GMail calls
+        if service_factory is None:
+            self.creds = get_credentials (config["client_secret"], config["access_token"])
+            refresh_in_background (self.creds, config["access_token"])
+            service_factory = lambda: build_service (self.creds)
+        self.service = service_factory () # gmail service
+        # replies & acceptance emails are sent in the background, so fetching & the FB loop don't wait on them
+        self.outbox = Outbox (service_factory, workers=config.get("send_workers", 4))
+        self.max_reply_tries = config.get ("max_reply_tries", 3) # cycles to try replying to an email before giving up on it
+
+        self.ledger = RedemptionLedger (config.get("datafile", "./data/emails_joined.csv")) # emails that have been issued codes & have joined
+        if not self.ledger.exists: # first start, import the acceptance emails we've already sent
+            self.seed_ledger ()
+        print (f"{len(self.ledger)} emails have joined")
+        self.journal = WorkJournal (config.get("journal", "./data/journal.csv")) # emails & requests whose handling was interrupted
+        print (f"{len(self.journal)} emails & requests to resume")
+
+        cache_opts = config.get ("validation_cache", {})
+        # (requester, code) -> (verdict, decrypted email, whether the email was redeemed at the time, valid email list version), so pending requests aren't re-validated every cycle
+        self.validations = LRUCache (cache_opts.get ("size", 10000), cache_opts.get ("ttl", 6*60*60))
+        self.redeemers = LRUCache (cache_opts.get ("size", 10000)) # email -> (requester, code) of the request that redeemed it
+        self.missing = dict () # journaled request ID -> number of scrapes in a row it has been missing from
+        for request_id in self.journal.pending (REQUEST): # approvals made before a restart that still have to be clicked
+            if self.journal.verdict (REQUEST, request_id) == True:
+                requester, code = request_id.rsplit (":", 1)
+                self.redeemers.put (self.codec.decrypt (code), (requester, code))
     
+    def seed_ledger (self):
+        """ Record every address we have sent an acceptance email to as redeemed """
+        emails = []
+        for sent in gmail_fetch_pages (self.service, f'is:sent subject:{self.subject_accept.replace (" ", "+")}'):
+            addresses = [ extract_name_email (m["to"]) for m in sent if m.get("to") ]
+            emails.extend (address[1] for address in addresses if address)
+        count = self.ledger.seed (emails) # written only once every page is in, so a failure part way means seeding again next start
+        print (f"seeded ledger with {count} emails from sent folder")
+
+    def load_history_id (self):
+        """ Read the persisted mailbox checkpoint, if any """
+        if not os.path.exists (self.sync_state_file):
+            return None
+        with open (self.sync_state_file, "r") as f:
+            return json.loads (f.read ()).get ("history_id")
+    def save_history_id (self, history_id: str):
+        directory = os.path.dirname (self.sync_state_file)
+        if directory:
+            os.makedirs (directory, exist_ok=True)
+        tmp_file = self.sync_state_file + ".tmp"
+        with open (tmp_file, "w") as f:
+            f.write (json.dumps ({"history_id": history_id}))
+        os.replace (tmp_file, self.sync_state_file) # atomic, so a crash never leaves a corrupt checkpoint
+        self.history_id = history_id
+
     def fetch (self):
-        """ Fetch & respond to valid emails """
-        # query to fetch the right emails
-        q = "is:unread subject:" + self.subject_q.replace (" ", "+") + (" after:" + str(self.last_fetch) if self.last_fetch else "")
-        messages = gmail_fetch (self.service, q) # fetch the emails
-        self.last_fetch = int (time.time())-5 # refresh last fetch time, subtract five to account for emails received during the fetch
-
-        print (f"got {len(messages)} emails")
-        for message in messages:
-            if message['subject'].lower() != self.subject_q: # if the subject does not strictly match, ignore the email
-                continue 
-
-            name, email = extract_name_email (message['from']) # extract the email from the RF-2822 format (name <email@mail.com>)
-
-            if not self.is_valid_email (email): # if the email is not valid, respond accordingly
-                print (email + ', invalid address')
-                txt = self.responses['invalid_email']
-            elif self.has_sent_acceptance_email(email): # if the email has already been validated, its a duplicate request
-                print (email + ', got duplicate email')
-                txt = self.responses['duplicate_email']
-            else: # all good, otherwise
-                print (email + ' requested to join, sending code')
-                
-                code = encrypt (email, self.encryption_key)
-                txt: str = self.responses['valid_email']
-                txt = txt.replace('[code]', code)
-
-            txt = (self.responses.get('wrapper') or '[content]').replace('[content]', txt)
-            txt = txt.replace('[name]', name)
+        """ 
+            Fetch & respond to valid emails; returns the number of new emails responded to (emails being retried don't count as work).
+            An email is only marked read once its reply has gone out, & the journal remembers the replied ones,
+            so an interrupted cycle is resumed without losing emails or replying twice.
+            The emails are marked read in one go once all the pages are in, as marking them read while paging through an is:unread query would skip some
+        """
+        # query to fetch the right emails, only used if we have no checkpoint to sync from
+        q = "is:unread subject:" + self.subject_q.replace (" ", "+")
+        pages, history_id = gmail_sync (self.service, q, self.history_id) # fetch the emails received since the last sync
+        unfinished = self.journal.pending (EMAIL) # emails an earlier cycle or run didn't finish
+        retry = set (unfinished)
+        if unfinished:
+            pages = itertools.chain ([ self.resume (unfinished) ], ( [ m for m in page if m['id'] not in retry ] for page in pages ))
+
+        replies = [] # (future, message ID) of replies still being sent
+        replied = [] # IDs of the emails replied to, to mark read
+        count, failed = 0, 0
+        for messages in pages: # replies to a page go out while the next page is being fetched
+            print (f"got {len(messages)} emails")
+            messages = [ m for m in messages if m.get('subject', '').lower() == self.subject_q ] # if the subject does not strictly match, ignore the email
+            replied.extend (m['id'] for m in messages if self.journal.state (EMAIL, m['id']) == REPLIED) # only need to be marked read
+            messages = [ m for m in messages if self.journal.state (EMAIL, m['id']) != REPLIED ]
+            self.journal.record (EMAIL, [ m['id'] for m in messages ], FETCHED)
+            for message in messages:
+                replies.append ((self.outbox.submit (self.reply, self.response_to (message), message), message['id'])) # reply
+            count += sum (1 for m in messages if m['id'] not in retry)
+            sent = set ( f for f, _ in replies if f.done () )
+            failed += self.settle ([ r for r in replies if r[0] in sent ], replied) # so memory doesn't grow with the backlog
+            replies = [ r for r in replies if r[0] not in sent ]
+        self.outbox.drain ([ f for f, _ in replies ]) # wait for the rest of the replies to go out
+        failed += self.settle (replies, replied)
+        read_emails (self.service, replied) # mark all the emails read in one go
+        self.journal.record (EMAIL, replied, MARKED_READ)
+        if failed:
+            print (f"failed to reply to {failed} emails")
+        self.save_history_id (history_id) # the checkpoint moves on, the emails that failed are retried from the journal
+        return count
+    def resume (self, mIDs: list):
+        """ Fetch the emails an earlier cycle left unfinished, forgetting the ones that have since been deleted """
+        messages = get_messages_metadata (self.service, mIDs)
+        found = set (m['id'] for m in messages)
+        self.journal.record (EMAIL, [ mID for mID in mIDs if mID not in found ], DROPPED)
+        return messages
+    def reply (self, service, text: str, message: dict):
+        """ Send the reply & journal it, runs in the outbox """
+        send_reply (service, text, message)
+        self.journal.record (EMAIL, [ message['id'] ], REPLIED)
+    def settle (self, replies: list, replied: list):
+        """ 
+            Add the emails whose (finished) replies went out to 'replied'; returns the number of replies that failed.
+            Failed replies are retried next cycle, unless the failure isn't transient or they've been tried max_reply_tries times
+        """
+        replied.extend (mID for f, mID in replies if f.exception () is None)
+        failures = [ (mID, f.exception ()) for f, mID in replies if f.exception () is not None ]
+        given_up = [ mID for mID, err in failures if not is_retryable (err) or self.journal.tries (EMAIL, mID) >= self.max_reply_tries ]
+        for mID, err in failures:
+            print (f"failed to reply to {mID}: {err}, " + ("giving up" if mID in given_up else "will retry next cycle"))
+        self.journal.record (EMAIL, given_up, DROPPED) # left unread, for a human to look at
+        return len (failures)
+    def response_to (self, message: dict):
+        """ The text to reply to an email with """
+        name, email = extract_name_email (message['from']) # extract the email from the RF-2822 format (name <email@mail.com>)
+
+        if not self.is_valid_email (email): # if the email is not valid, respond accordingly
+            print (email + ', invalid address')
+            txt = self.responses['invalid_email']
+        elif self.has_sent_acceptance_email(email): # if the email has already been validated, its a duplicate request
+            print (email + ', got duplicate email')
+            txt = self.responses['duplicate_email']
+        else: # all good, otherwise
+            print (email + ' requested to join, sending code')
             
-            read_email (self.service, message['id']) # mark the email read
-            send_reply (self.service, txt, message) # reply
+            code = self.codec.encrypt (email)
+            txt: str = self.responses['valid_email']
+            txt = txt.replace('[code]', code)
+            self.ledger.issue (email)
+
+        txt = (self.responses.get('wrapper') or '[content]').replace('[content]', txt)
+        txt = txt.replace('[name]', name)
+        return txt
     def has_sent_acceptance_email (self, email: str):
-        m = gmail_fetch (self.service, f'is:sent to:{email} subject:{self.subject_accept.replace (" ", "+")}') 
-        return len(m) > 0
+        """ Check the ledger for whether the email has already been used to join """
+        return self.ledger.is_redeemed (email)
     def send_acceptance_email (self, email: str, fbName: str):
+        """ Queue the confirmation email, returns the future of the send """
         subject = self.subject_accept
         text = self.responses['accept_email']
         text = self.responses['wrapper'].replace('[content]', text)
         text = text.replace('[name]', fbName)
         
-        send_email(self.service, email, subject, text)
+        return self.outbox.submit (send_email, email, subject, text)
+    def close (self):
+        """ Finish sending queued emails """
+        self.outbox.close ()
 
     def is_valid_email (self, email):
-        """ Check if the email is valid"""    
-        return self.email_regex.match (email.lower()) != None or (email.lower() in self.valid_emails_list)
+        """ Check if the email is valid; verdicts are cached till the valid email list changes """    
+        self.valid_emails_list.maybe_reload ()
+        email = email.lower()
+        version = self.valid_emails_list.version
+        cached = self.email_verdicts.get (email)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        valid = email in self.valid_emails_list or self.email_regex.match (email) != None
+        self.email_verdicts.put (email, (version, valid))
+        return valid
 
-    def validate (self, name: str, answer: str):
-        """ Verify if the answer is a valid code """
+    def clicked (self, requester: str, name: str, answer: str):
+        """ Record that the request's verdict has been acted on in FB; an approval is used up by its click """
+        code = answer.replace ("\n", "").replace (" ", "")
+        self.validations.pop ((requester, code))
+        if requester:
+            self.journal.record (REQUEST, [ self.request_id (requester, code) ], CLICKED)
+    def request_id (self, requester: str, code: str):
+        return requester + ":" + code
+    def scraped (self, group_url: str, requesters: list):
+        """ 
+            Forget the group's requests that were validated but are no longer pending (eg. withdrawn before being clicked),
+            so their journal entries don't outlive them. Requesters are of the form group_url#user (see fb_automation.requester_id).
+            As the page may not have loaded fully, a request is only forgotten once it's been missing from DROP_AFTER_SCRAPES scrapes in a row,
+            & empty scrapes are ignored
+        """
+        if not requesters:
+            return
+        requesters = set (requesters)
+        gone = []
+        for request_id in self.journal.pending (REQUEST):
+            if not request_id.startswith (group_url + "#"):
+                continue
+            if request_id.rsplit (":", 1)[0] in requesters:
+                self.missing.pop (request_id, None)
+                continue
+            self.missing[request_id] = self.missing.get (request_id, 0) + 1
+            if self.missing[request_id] >= DROP_AFTER_SCRAPES:
+                del self.missing[request_id]
+                gone.append (request_id)
+        self.journal.record (REQUEST, gone, DROPPED)
+
+    def validate (self, requester: str, name: str, answer: str):
+        """ 
+            Verify if the answer is a valid code; the verdict is remembered for requests that are seen again in later cycles.
+            'requester' is a stable identity of the request (see fb_automation.requester_id), unlike the name it can't be copied;
+            verdicts of requests without one aren't remembered
+        """
         if not answer:
             return
-            
+        with metrics.timed ("validate_seconds"):
+            validated = self._validate (requester, name, answer)
+        metrics.inc ("validations_total", verdict=str(validated).lower ())
+        return validated
+    def _validate (self, requester: str, name: str, answer: str):
         code = answer.replace ("\n", "").replace (" ", "") # remove whitespace
+        key = (requester, code)
+        cached = self.validations.get (key) if requester else None
+        if cached is not None and self.is_current (key, cached):
+            print (f"{name} already validated: {cached[0]}")
+            metrics.inc ("validation_cache_hits_total")
+            if cached[0] == True and self.journal.state (REQUEST, self.request_id (requester, code)) is None: # dropped from the journal while off the page
+                self.journal.record (REQUEST, [ self.request_id (requester, code) ], VALIDATED, True)
+            return cached[0]
+
+        request_id = requester and self.request_id (requester, code)
+        if requester and self.journal.state (REQUEST, request_id) == VALIDATED: # validated but not clicked before a restart, the code may already be redeemed
+            verdict = self.journal.verdict (REQUEST, request_id)
+            if verdict != True or self.is_redeemer (key, self.codec.decrypt (code)):
+                print (f"{name} was validated before restarting: {verdict}")
+                return verdict
+
+        validated, email = self.validate_code (name, code, key)
+        if requester:
+            self.journal.record (REQUEST, [ request_id ], VALIDATED, validated)
+            self.validations.put (key, (validated, email, email is not None and self.ledger.is_redeemed (email), self.valid_emails_list.version))
+        return validated
+    def is_redeemer (self, key: tuple, email: str):
+        """ Whether the request 'key' is the one that redeemed the email's code """
+        return self.ledger.is_redeemed (email) and self.redeemers.get (email) == key
+    def is_current (self, key: tuple, cached: tuple):
+        """ 
+            A verdict only holds while the email's redemption state & the valid email list are what they were when the verdict was made,
+            & an approval only for the request that redeemed the code
+        """
+        validated, email, redeemed, list_version = cached
+        if validated == True and not self.is_redeemer (key, email):
+            return False
+        return email is None or (self.ledger.is_redeemed (email) == redeemed and self.valid_emails_list.version == list_version)
+    def validate_code (self, name: str, code: str, key: tuple=None):
+        """ Decrypt & validate the code for the request 'key'; returns the verdict & the decrypted email (None if decryption failed) """
         try:
-            code = decrypt (code, self.encryption_key) # decrypt the code
+            email = self.codec.decrypt (code) # decrypt the code; malformed codes are rejected before decrypting
         except Exception as err:
             print (f"{name} decryption failed for '{code}': {err}") # if decryption failed, then just fail
-            return False
-        if not self.is_valid_email (code): # if the code is not a valid email, fail
-            print (f"{name} email validation failed for '{code}'") 
-            return False
-        if self.has_sent_acceptance_email(code): # if the code has already been used for validation, fail
-            print (f"{name} sent duplicate code: '{code}'") 
-            return False
-        print (f"{name} successful authentication: '{code}'")
-        self.send_acceptance_email(code, name)
-        return True
+            return False, None
+        if not self.is_valid_email (email): # if the code is not a valid email, fail
+            print (f"{name} email validation failed for '{email}'") 
+            return False, email
+        if not self.ledger.redeem (email): # if the code has already been used for validation, fail; otherwise mark it used
+            print (f"{name} sent duplicate code: '{email}'") 
+            return False, email
+        self.redeemers.put (email, key)
+        print (f"{name} successful authentication: '{email}'")
+        self.send_acceptance_email(email, name)
+        return True, email
 def test_email_verification (verifier):
     """ Small unit test to verify the email regex works for Ashoka """
     def is_valid_email (email):
@@ -126,7 +318,106 @@ def test_email_verification (verifier):
     assert is_valid_email ("shruthisagar@alumni.ashoka.edu.in")
     assert is_valid_email ("aaditya.shetty@alumni.ashoka.edu.in")
     assert not is_valid_email ("adhiraj1.singh123@alumni2.ashoka.edu.in")
+def test_request_identity ():
+    """ An approval is remembered only for the request that redeemed the code, not for anyone using the same name & code """
+    import tempfile
+    from fakes import FakeGmailService
+    with tempfile.TemporaryDirectory () as directory:
+        config = {
+            "encryption_key": "testEncryptionKey", "valid_email_regex": "^[a-z0-9.]+_ug[0-9]{2}@ashoka.edu.in$",
+            "email_subject": "Join FB Group", "accepted_email_subject": "Accepted to FB group",
+            "responses": { "wrapper": "[content]", "accept_email": "accepted" },
+            "datafile": os.path.join (directory, "ledger.csv"), "sync_state": os.path.join (directory, "sync.json"), "journal": os.path.join (directory, "journal.csv")
+        }
+        service = FakeGmailService ()
+        verifier = Verifier (config, service_factory=lambda: service)
+        code = verifier.codec.encrypt ("alice.a_ug21@ashoka.edu.in")
+        alice, mallory = "group#1", "group#2"
+        assert verifier.validate (alice, "Alice A", code) == True
+        assert verifier.validate (alice, "Alice A", code) == True # still pending, the approval is remembered
+        assert verifier.validate (mallory, "Alice A", code) == False # same name & code, different person
+        verifier.clicked (alice, "Alice A", code)
+        assert verifier.validate (alice, "Alice A", code) == False # the approval was used up by the click
+        assert verifier.validate (None, "Alice A", code) == False
+
+        bob = "group#3"
+        code = verifier.codec.encrypt ("bob.b_ug21@ashoka.edu.in")
+        assert verifier.validate (bob, "Bob B", code) == True
+        verifier.close ()
+        verifier = Verifier (config, service_factory=lambda: service) # restart before Bob's request is clicked
+        assert verifier.validate ("group#4", "Bob B", code) == False
+        assert verifier.validate (bob, "Bob B", code) == True # from the journal
+        verifier.scraped ("group", []) # the list hadn't loaded
+        verifier.scraped ("group", [ "group#4" ]) # Bob withdrew
+        assert verifier.journal.state (REQUEST, verifier.request_id (bob, code)) == VALIDATED # could still be further down the page
+        for _ in range (DROP_AFTER_SCRAPES - 1):
+            verifier.scraped ("group", [ "group#4" ])
+        verifier.close ()
+        verifier = Verifier (config, service_factory=lambda: service)
+        assert verifier.journal.pending (REQUEST) == [ verifier.request_id ("group#4", code) ]
+        assert verifier.validate (bob, "Bob B", code) == False
+        verifier.close ()
+
+def test_unconfirmed_click ():
+    """ An approval whose click FB ignored is still remembered, so the next cycle approves the request again instead of declining it as a duplicate """
+    import tempfile
+    from fakes import FakeGmailService, FakeBrowser
+    from fb_automation import handle_requests
+    with tempfile.TemporaryDirectory () as directory:
+        config = {
+            "encryption_key": "testEncryptionKey", "valid_email_regex": "^[a-z0-9.]+_ug[0-9]{2}@ashoka.edu.in$",
+            "email_subject": "Join FB Group", "accepted_email_subject": "Accepted to FB group",
+            "responses": { "wrapper": "[content]", "accept_email": "accepted" },
+            "datafile": os.path.join (directory, "ledger.csv"), "sync_state": os.path.join (directory, "sync.json"), "journal": os.path.join (directory, "journal.csv")
+        }
+        service = FakeGmailService ()
+        verifier = Verifier (config, service_factory=lambda: service)
+        browser = FakeBrowser ([ ("Alice A", verifier.codec.encrypt ("alice.a_ug21@ashoka.edu.in")) ])
+        fb_config = { "group_url": "group", "scrape_with_script": True, "waits": { "click": 0.1 } }
+        browser.ignored.add ("Alice A")
+        assert handle_requests (browser, fb_config, verifier.validate, verifier.clicked, verifier.scraped) == 0
+        assert verifier.journal.state (REQUEST, verifier.journal.pending (REQUEST)[0]) == VALIDATED
+        browser.ignored.clear ()
+        assert handle_requests (browser, fb_config, verifier.validate, verifier.clicked, verifier.scraped) == 1
+        assert browser.clicks["Alice A"] == "approve" and len (verifier.journal) == 0
+        verifier.close ()
+
+def test_failed_replies ():
+    """ Emails whose replies keep failing are given up on, & retrying them doesn't count as work """
+    import tempfile
+    import gmail_utils
+    from fakes import FakeGmailService
+    from rate_limit import QuotaLimiter
+    limiter = gmail_utils.limiter
+    gmail_utils.limiter = QuotaLimiter (1e9, max_retries=0) # fail straight away
+    try:
+        with tempfile.TemporaryDirectory () as directory:
+            config = {
+                "encryption_key": "testEncryptionKey", "valid_email_regex": "^[a-z0-9.]+_ug[0-9]{2}@ashoka.edu.in$",
+                "email_subject": "Join FB Group", "accepted_email_subject": "Accepted to FB group", "max_reply_tries": 2,
+                "responses": { "wrapper": "[content]", "valid_email": "[code]", "invalid_email": "invalid", "duplicate_email": "duplicate" },
+                "datafile": os.path.join (directory, "ledger.csv"), "sync_state": os.path.join (directory, "sync.json"), "journal": os.path.join (directory, "journal.csv")
+            }
+            service = FakeGmailService ()
+            service.failing_sends = { "bad.one_ug21@ashoka.edu.in": 400, "down.one_ug21@ashoka.edu.in": 503 }
+            for name in ["bad.one", "down.one", "good.one"]:
+                service.add_message (f"Someone <{name}_ug21@ashoka.edu.in>", "Join FB Group")
+            verifier = Verifier (config, service_factory=lambda: service)
+            assert verifier.fetch () == 3
+            assert len (verifier.journal) == 1 # the 400 is given up on straight away, the 503 is retried
+            assert verifier.fetch () == 0 # only a retry
+            assert len (verifier.journal) == 0 # tried twice
+            assert verifier.fetch () == 0
+            sent = [ m for m in service.mailbox.values () if "SENT" in m["labelIds"] ]
+            assert len (sent) == 1
+            verifier.close ()
+    finally:
+        gmail_utils.limiter = limiter
+
 if __name__ == "__main__":
+    test_request_identity ()
+    test_unconfirmed_click ()
+    test_failed_replies ()
     with open ("./config/config.json", "r") as f:
         data = f.read ()
         config = json.loads (data)